@@ -0,0 +1,762 @@
+#!/usr/bin/env python3
+"""
+Offline benchmarks for streamdeck-daemon.py.
+Runs against the daemon's own classes; needs the same Python packages as
+the daemon service but no StreamDeck hardware or Home Assistant. A fake deck
+records key writes (with simulated USB latency) and a local aiohttp server
+stands in for Home Assistant's websocket API.
+
+Usage: streamdeck-bench.py decode [--frames FILE] [--count N]
+       streamdeck-bench.py render [--count N]
+       streamdeck-bench.py composite [--count N]
+       streamdeck-bench.py encode [--count N]
+       streamdeck-bench.py press [--count N] [--usb-latency S]
+       streamdeck-bench.py events [--count N] [--rate HZ]
+       streamdeck-bench.py reconnect [--count N]
+       streamdeck-bench.py all [--output FILE]
+"""
+
+import argparse
+import asyncio
+import importlib.util
+import json
+import math
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+DAEMON_PATH = Path(__file__).with_name("streamdeck-daemon.py")
+REPO_ICONS = Path(__file__).resolve().parent.parent / "streamdeck" / "icons"
+REPO_LAYOUT = REPO_ICONS.with_name("layout.toml")
+
+
+def load_daemon():
+    """Import streamdeck-daemon.py as a module (its name is not importable)."""
+    spec = importlib.util.spec_from_file_location("streamdeck_daemon", DAEMON_PATH)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module  # dataclasses resolve string annotations through it
+    spec.loader.exec_module(module)
+    return module
+
+
+# === Recorded / synthetic WS streams ===
+
+WATCHED = [
+    "input_boolean.climate_office_toggle",
+    "sensor.awair_element_54484_temperature",
+]
+
+
+def synthetic_subscribe_entities(count: int, seed: int = 1) -> list[str]:
+    """A subscribe_entities stream, as STREAMDECK_WS_RECORD records it.
+
+    One "a" frame with the watched entities' full states, then "c" diffs
+    (state and timestamp, now and then attributes), with the odd result frame
+    for a service call in between.
+    """
+    rng = random.Random(seed)
+    entities = WATCHED + [f"light.room_{i}" for i in range(12)] + ["media_player.bureau"]
+    added = {
+        entity_id: {
+            "s": "on",
+            "a": {"friendly_name": entity_id, "brightness": 255, "color_mode": "brightness",
+                  "supported_color_modes": ["brightness"], "supported_features": 40},
+            "c": "01J0000000000000000000000", "lc": 1767225600.0,
+        }
+        for entity_id in entities
+    }
+    frames = [json.dumps({"id": 2, "type": "event", "event": {"a": added}}, separators=(",", ":"))]
+    for i in range(count - 1):
+        if i % 50 == 49:
+            frames.append(json.dumps({"id": 3 + i, "type": "result", "success": True, "result": None},
+                                     separators=(",", ":")))
+            continue
+        entity_id = rng.choice(entities)
+        diff = {"s": f"{rng.uniform(15, 25):.1f}", "c": f"01J{i:022d}", "lc": 1767225600.0 + i}
+        if rng.random() < 0.3:
+            diff["a"] = {"brightness": rng.randrange(256), "volume_level": round(rng.random(), 2)}
+        frames.append(json.dumps({"id": 2, "type": "event", "event": {"c": {entity_id: {"+": diff}}}},
+                                 separators=(",", ":")))
+    return frames
+
+
+def load_frames(path: Path | None, count: int) -> list[str]:
+    if path is None:
+        return synthetic_subscribe_entities(count)
+    return [line for line in path.read_text().splitlines() if line]
+
+
+# === Fake StreamDeck ===
+
+class FakeStreamDeck:
+    """In-memory Stream Deck Original (V2): records key writes, sleeps like USB."""
+
+    KEY_IMAGE_FORMAT = {"size": (72, 72), "format": "JPEG", "flip": (True, True), "rotation": 0}
+    # Image bytes per USB report after the header (as StreamDeckOriginalV2)
+    IMAGE_REPORT_PAYLOAD_LENGTH = 1016
+
+    def __init__(self, serial: str = "BENCH0001", usb_latency: float = 0.002):
+        self.serial = serial
+        self.usb_latency = usb_latency
+        # (perf_counter, key, bytes) per set_key_image call
+        self.writes: list[tuple[float, int, int]] = []
+        self.brightness: list[int] = []
+        self.callback = None
+        self._cond = threading.Condition()
+
+    def id(self):
+        return f"fake:{self.serial}"
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def reset(self):
+        pass
+
+    def connected(self):
+        return True
+
+    def get_serial_number(self):
+        return self.serial
+
+    def deck_type(self):
+        return "Stream Deck Original"
+
+    def key_count(self):
+        return 15
+
+    def key_layout(self):
+        return (3, 5)
+
+    def key_image_format(self):
+        return self.KEY_IMAGE_FORMAT
+
+    def set_key_callback(self, callback):
+        self.callback = callback
+
+    def set_brightness(self, percent):
+        time.sleep(self.usb_latency)
+        self.brightness.append(percent)
+
+    def set_key_image(self, key, image):
+        time.sleep(self.usb_latency)
+        with self._cond:
+            self.writes.append((time.perf_counter(), key, len(image)))
+            self._cond.notify_all()
+
+    def press(self, key: int, state: bool):
+        """Deliver a key event the way the USB read thread would."""
+        self.callback(self, key, state)
+
+    def wait_for_write(self, key: int, after: float, timeout: float = 2.0) -> float | None:
+        """Time of the first write to key at or after `after`, or None on timeout."""
+        deadline = time.perf_counter() + timeout
+        with self._cond:
+            seen = 0
+            while True:
+                for when, k, _ in self.writes[seen:]:
+                    if k == key and when >= after:
+                        return when
+                seen = len(self.writes)
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0 or not self._cond.wait(remaining):
+                    return None
+
+    def wait_idle(self, quiet: float = 0.05, timeout: float = 5.0):
+        """Block until no key has been written for `quiet` seconds."""
+        deadline = time.perf_counter() + timeout
+        while time.perf_counter() < deadline:
+            with self._cond:
+                last = self.writes[-1][0] if self.writes else 0.0
+            if time.perf_counter() - last >= quiet:
+                return
+            time.sleep(quiet / 2)
+
+
+# === Fake Home Assistant ===
+
+class FakeHAServer:
+    """Local stand-in for HA's websocket API on its own thread and event loop.
+
+    Speaks auth, get_states, subscribe_events, subscribe_entities,
+    unsubscribe_events and call_service; toggle/turn_on/turn_off flip the
+    target entity and push the change like HA would.
+    """
+
+    TOKEN = "bench-token"
+
+    def __init__(self, states: dict[str, str]):
+        self.states = {entity_id: {"s": state, "a": {}, "lc": time.time()}
+                       for entity_id, state in states.items()}
+        self.calls: list[dict] = []
+        self.subscribe_times: list[float] = []
+        self.subscribed = threading.Event()
+        self.url = None
+        self.loop = None
+        # ws -> {"entities": sub id, "entity_ids": set | None, "events": sub id}
+        self._clients: dict = {}
+
+    def start(self) -> str:
+        from aiohttp import web
+
+        ready = threading.Event()
+
+        def run():
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+            app = web.Application()
+            app.router.add_get("/api/websocket", self._handle)
+            runner = web.AppRunner(app)
+            self.loop.run_until_complete(runner.setup())
+            self.loop.run_until_complete(web.TCPSite(runner, "127.0.0.1", 0).start())
+            host, port = runner.addresses[0][:2]
+            self.url = f"ws://{host}:{port}/api/websocket"
+            ready.set()
+            self.loop.run_forever()
+
+        threading.Thread(target=run, daemon=True, name="fake-ha").start()
+        ready.wait()
+        return self.url
+
+    def _run(self, coro, timeout: float | None = None):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    async def _handle(self, request):
+        import aiohttp
+        from aiohttp import web
+
+        ws = web.WebSocketResponse(max_msg_size=0)
+        await ws.prepare(request)
+        await ws.send_json({"type": "auth_required", "ha_version": "2026.10.0"})
+        auth = await ws.receive_json()
+        if auth.get("type") != "auth" or auth.get("access_token") != self.TOKEN:
+            await ws.send_json({"type": "auth_invalid", "message": "Invalid access token"})
+            await ws.close()
+            return ws
+        await ws.send_json({"type": "auth_ok", "ha_version": "2026.10.0"})
+
+        client = {}
+        self._clients[ws] = client
+        try:
+            async for msg in ws:
+                if msg.type == aiohttp.WSMsgType.TEXT:
+                    await self._dispatch(ws, client, json.loads(msg.data))
+        finally:
+            self._clients.pop(ws, None)
+        return ws
+
+    async def _dispatch(self, ws, client: dict, msg: dict):
+        msg_id, kind = msg.get("id"), msg.get("type")
+        result = None
+        if kind == "get_states":
+            result = [self._full_state(entity_id) for entity_id in self.states]
+        elif kind == "subscribe_events":
+            client["events"] = msg_id
+        elif kind == "subscribe_entities":
+            ids = msg.get("entity_ids")
+            client["entities"] = msg_id
+            client["entity_ids"] = set(ids) if ids else None
+        elif kind == "unsubscribe_events":
+            for key in ("events", "entities"):
+                if client.get(key) == msg.get("subscription"):
+                    del client[key]
+        elif kind == "call_service":
+            self.calls.append(msg)
+            result = {"context": {"id": f"bench{msg_id}", "parent_id": None, "user_id": None}}
+        else:
+            await ws.send_json({"id": msg_id, "type": "result", "success": False,
+                                "error": {"code": "unknown_command", "message": "Unknown command."}})
+            return
+        await ws.send_json({"id": msg_id, "type": "result", "success": True, "result": result})
+
+        if kind == "subscribe_entities":
+            added = {entity_id: state for entity_id, state in self.states.items()
+                     if client["entity_ids"] is None or entity_id in client["entity_ids"]}
+            await ws.send_json({"id": msg_id, "type": "event", "event": {"a": added}})
+            self.subscribe_times.append(time.perf_counter())
+            self.subscribed.set()
+        elif kind == "call_service":
+            service = msg.get("service")
+            entity_ids = msg.get("service_data", {}).get("entity_id", ())
+            for entity_id in [entity_ids] if isinstance(entity_ids, str) else entity_ids:
+                state = self.states.get(entity_id, {}).get("s")
+                if state is None:
+                    continue
+                if service == "toggle":
+                    state = {"on": "off", "off": "on", "open": "closed", "closed": "open"}.get(state, state)
+                elif service in ("turn_on", "turn_off"):
+                    state = service[5:]
+                await self._change(entity_id, state)
+
+    def _full_state(self, entity_id: str) -> dict:
+        state = self.states[entity_id]
+        stamp = time.strftime("%Y-%m-%dT%H:%M:%S+00:00", time.gmtime(state["lc"]))
+        return {"entity_id": entity_id, "state": state["s"], "attributes": state["a"],
+                "last_changed": stamp, "last_updated": stamp}
+
+    async def _change(self, entity_id: str, value: str):
+        """Set an entity's state and push it to every subscribed client."""
+        old = self._full_state(entity_id)
+        now = time.time()
+        self.states[entity_id].update(s=value, lc=now)
+        for ws, client in list(self._clients.items()):
+            if "entities" in client and (client["entity_ids"] is None
+                                         or entity_id in client["entity_ids"]):
+                await ws.send_json({"id": client["entities"], "type": "event",
+                                    "event": {"c": {entity_id: {"+": {"s": value, "lc": now}}}}})
+            if "events" in client:
+                await ws.send_json({"id": client["events"], "type": "event", "event": {
+                    "event_type": "state_changed",
+                    "data": {"entity_id": entity_id, "old_state": old,
+                             "new_state": self._full_state(entity_id)},
+                }})
+
+    def replay(self, entity_id: str, count: int, rate: float | None = None):
+        """Push `count` state changes for one entity, paced at `rate` per second if given."""
+        async def run():
+            start = time.perf_counter()
+            for i in range(count):
+                if rate:
+                    delay = start + i / rate - time.perf_counter()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                await self._change(entity_id, f"{i / 10:.1f}")
+        self._run(run())
+
+    def drop_connections(self):
+        """Close every client connection, as an HA restart or network blip would."""
+        async def run():
+            for ws in list(self._clients):
+                await ws.close()
+        self.subscribed.clear()
+        self._run(run(), timeout=5)
+
+
+class EventCounter:
+    """Entity-store subscriber that counts updates and signals at a target."""
+
+    def __init__(self, entity_id: str):
+        self.watched_entities = frozenset({entity_id})
+        self.count = 0
+        self.target = None
+        self.done = threading.Event()
+
+    def expect(self, count: int):
+        self.count = 0
+        self.target = count
+        self.done.clear()
+
+    def update_entity(self, entity_id: str, state_data: dict):
+        self.count += 1
+        if self.target is not None and self.count >= self.target:
+            self.done.set()
+
+
+# === Bench session ===
+
+SENSOR = "sensor.bench_temperature"
+TOGGLE = "input_boolean.bench_climate"
+LIGHTS = [f"light.bench_{i}" for i in range(5)]
+
+BENCH_LAYOUT = {
+    "start_page": "main",
+    "pages": {"main": {"keys": {
+        **{str(i): {"type": "ha_state", "service": "light/toggle", "entity_id": entity_id,
+                    "text": f"Light {i}", "icon": "light.png", "bg_color": "#fbc02d",
+                    "states": {"off": {"bg_color": "#424242"}}}
+           for i, entity_id in enumerate(LIGHTS)},
+        "5": {"type": "trv", "toggle_entity": TOGGLE, "temp_entity": SENSOR, "label": "Bench"},
+        "6": {"type": "ha", "service": "script/turn_on", "entity_id": "script.bench",
+              "text": "Script", "icon": "sleep.png", "bg_color": "#3949ab"},
+    }}},
+}
+
+
+def prepare_daemon(daemon):
+    """Point the daemon at the repo icons and keep the bench out of ~/.cache."""
+    daemon.ICONS_DIR = REPO_ICONS
+    daemon._assets = daemon.AssetStore(REPO_ICONS)
+    daemon._render_cache.disk_dir = None
+    daemon.FONT_PATH = daemon._find_font()
+    daemon._assets.preload()
+
+
+class BenchSession:
+    """A daemon DeckController on a FakeStreamDeck, connected to a FakeHAServer."""
+
+    def __init__(self, daemon, usb_latency: float):
+        self.daemon = daemon
+        self.server = FakeHAServer({**{entity_id: "off" for entity_id in LIGHTS},
+                                    SENSOR: "21.0", TOGGLE: "on"})
+        self.deck = FakeStreamDeck(usb_latency=usb_latency)
+        self.counter = EventCounter(SENSOR)
+        self.controller = None
+        self.loop_thread = None
+        self._ha_task = None
+        self._token_dir = tempfile.TemporaryDirectory(prefix="streamdeck-bench-")
+
+    def __enter__(self):
+        d = self.daemon
+        d.HA_URL = self.server.start()
+        d.HA_TOKEN_FILE = Path(self._token_dir.name) / "token"
+        d.HA_TOKEN_FILE.write_text(FakeHAServer.TOKEN)
+
+        # The daemon's event loop, on a thread of its own so the bench can block
+        d._loop = asyncio.new_event_loop()
+        self.loop_thread = threading.Thread(target=d._loop.run_forever, daemon=True, name="loop")
+        self.loop_thread.start()
+
+        layout = d.compile_layout(BENCH_LAYOUT, Path("<bench>"), "bench")
+        self.controller = d.DeckController(self.deck)
+        self.run(self.controller.open(layout))
+        d._entities.set_subscribers("bench-counter", [self.counter])
+
+        self._ha_task = self.run(self._spawn(d.ha_websocket_loop()))
+        if not self.server.subscribed.wait(10):
+            raise RuntimeError("daemon never subscribed to the fake HA server")
+        self.deck.wait_idle()
+        return self
+
+    def __exit__(self, *exc):
+        self.run(self._cancel(self._ha_task))
+        self.run(self.controller.close())
+        self.daemon._loop.call_soon_threadsafe(self.daemon._loop.stop)
+        self.loop_thread.join(5)
+        self._token_dir.cleanup()
+
+    def run(self, coro, timeout: float = 10.0):
+        """Run a coroutine on the daemon's loop and wait for its result."""
+        return asyncio.run_coroutine_threadsafe(coro, self.daemon._loop).result(timeout)
+
+    @staticmethod
+    async def _spawn(coro) -> asyncio.Task:
+        return asyncio.get_running_loop().create_task(coro)
+
+    @staticmethod
+    async def _cancel(task: asyncio.Task):
+        """Cancel a task and wait until its cleanup is done, as the daemon does on shutdown."""
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    def thread_cpu(self) -> dict[str, float]:
+        """CPU seconds used so far by the event loop and USB threads."""
+        threads = {"loop": self.loop_thread}
+        threads.update((f"usb{i}", thread) for i, thread in enumerate(self.daemon._usb._threads))
+        return {name: time.clock_gettime(time.pthread_getcpuclockid(thread.ident))
+                for name, thread in threads.items()}
+
+
+# === Benchmarks ===
+
+def _summary(samples: list[float], scale: float = 1e3) -> dict:
+    """min / median / p95 / max of samples, scaled (default: seconds to ms)."""
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+    return {
+        "count": len(ordered),
+        "min": round(ordered[0] * scale, 3),
+        "median": round(statistics.median(ordered) * scale, 3),
+        "p95": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * scale, 3),
+        "max": round(ordered[-1] * scale, 3),
+    }
+
+
+def bench_decode(daemon, frames: list[str]) -> dict:
+    """WS frame decoding: json.loads vs the daemon's decoder (orjson when installed)."""
+    results = {"frames": len(frames), "orjson": daemon.orjson is not None}
+    for name, loads in (("json", json.loads), ("daemon", daemon._loads)):
+        start = time.perf_counter()
+        events = sum(1 for raw in frames if loads(raw).get("type") == "event")
+        elapsed = time.perf_counter() - start
+        results[name] = {
+            "seconds": round(elapsed, 6),
+            "us_per_frame": round(elapsed / max(len(frames), 1) * 1e6, 3),
+            "events": events,
+        }
+    results["speedup"] = round(results["json"]["seconds"] / max(results["daemon"]["seconds"], 1e-9), 2)
+    return results
+
+
+def bench_render(daemon, count: int) -> dict:
+    """Keys/s for cold renders (unique styles) and for render cache hits."""
+    prepare_daemon(daemon)
+    deck = FakeStreamDeck(usb_latency=0)
+    cache = daemon._render_cache
+    cache.maxsize = max(cache.maxsize, count)
+    cache.clear()
+    button = daemon.Button(0, "Bench", str(REPO_ICONS / "light.png"))
+    button.deck = deck
+
+    results = {}
+    for name in ("cold", "cached"):
+        start = time.perf_counter()
+        for i in range(count):
+            button.bg_color = f"#{i * 2654435761 % 0xFFFFFF:06x}"
+            button.render_native()
+        elapsed = time.perf_counter() - start
+        results[name] = {"keys_per_second": round(count / elapsed, 1),
+                         "ms_per_key": round(elapsed / count * 1e3, 3)}
+    results["cache"] = {"hits": cache.hits, "misses": cache.misses}
+    return results
+
+
+def bench_composite(daemon, count: int) -> dict:
+    """Renders of the repo layout's start page: every key on its own vs one whole-deck canvas.
+
+    The keys are drawn per key either way; what a deck compositor can add is
+    the batching, so the canvas path pastes them on one deck-sized image,
+    orients it in a single pass and crops and encodes each key from it.
+    """
+    prepare_daemon(daemon)
+    daemon._import_pil()
+    from PIL import Image
+
+    deck = FakeStreamDeck(usb_latency=0)
+    layout = daemon.load_layout(REPO_LAYOUT)
+    buttons = layout.default.build_pages(deck.key_count())[layout.default.start_page]
+    for button in buttons.values():
+        button.deck = deck
+    keys = [key for key in range(deck.key_count()) if key in buttons]
+    encoder = daemon.NativeEncoder(deck)
+    rows, columns = deck.key_layout()
+    width, height = deck.key_image_format()["size"]
+    origins = {key: (key % columns * width, key // columns * height) for key in keys}
+    size = (columns * width, rows * height)
+    # Where each key's tile lands after orientation: orient a canvas of key indices
+    index = Image.new("L", size)
+    for key, (x, y) in origins.items():
+        index.paste(key + 1, (x, y, x + width, y + height))
+    index = encoder.orient(index)
+    tiles = {key: index.point(lambda v, k=key + 1: 255 if v == k else 0).getbbox() for key in keys}
+
+    def per_key():
+        return {key: buttons[key]._encode() for key in keys}
+
+    def composited():
+        canvas = Image.new("RGB", size)
+        for key in keys:
+            canvas.paste(buttons[key].render(), origins[key])
+        native = encoder.orient(canvas)
+        return {key: encoder.save(native.crop(tiles[key])) for key in keys}
+
+    results = {"keys": len(keys), "pages": count}
+    outputs = {}
+    for name, fn in (("per_key", per_key), ("composite", composited)):
+        fn()  # Warm up fonts and icons
+        start = time.perf_counter()
+        for _ in range(count):
+            outputs[name] = fn()
+        elapsed = time.perf_counter() - start
+        results[name] = {"keys_per_second": round(count * len(keys) / elapsed, 1),
+                         "ms_per_page": round(elapsed / count * 1e3, 3)}
+    results["speedup"] = round(results["composite"]["keys_per_second"]
+                               / results["per_key"]["keys_per_second"], 2)
+    results["identical"] = outputs["per_key"] == outputs["composite"]
+    return results
+
+
+ENCODE_SETTINGS = [(quality, subsampling) for quality in (100, 95, 90, 85, 75)
+                   for subsampling in ("4:4:4", "4:2:0")]
+
+
+def bench_encode(daemon, count: int) -> dict:
+    """Encode time, USB transfer size and fidelity of the repo layout's keys per JPEG setting.
+
+    "pilhelper" is PILHelper.to_native_format (quality=100, Pillow's default
+    subsampling), which the daemon used before it encoded keys itself.
+    """
+    from io import BytesIO
+
+    from PIL import Image, ImageChops, ImageStat
+    from StreamDeck.ImageHelpers import PILHelper
+
+    prepare_daemon(daemon)
+    daemon._import_pil()
+    deck = FakeStreamDeck(usb_latency=0)
+    layout = daemon.load_layout(REPO_LAYOUT)
+    buttons = layout.default.build_pages(deck.key_count())[layout.default.start_page]
+    images = []
+    for button in buttons.values():
+        button.deck = deck
+        images.append(button.render())
+    default = daemon.EncodeSettings()
+
+    def measure(encode, orient) -> dict:
+        start = time.perf_counter()
+        for _ in range(count):
+            encoded = [encode(image) for image in images]
+        elapsed = time.perf_counter() - start
+        sizes = [len(data) for data in encoded]
+        # Fidelity: decoded key vs the exact pixels, as PSNR over all keys
+        squared = sum(sum(ImageStat.Stat(ImageChops.difference(
+            orient(image), Image.open(BytesIO(data)).convert("RGB"))).sum2)
+            for image, data in zip(images, encoded))
+        mse = squared / (3 * sum(image.width * image.height for image in images))
+        return {
+            "us_per_key": round(elapsed / (count * len(images)) * 1e6, 1),
+            "bytes_per_key": round(statistics.mean(sizes)),
+            "usb_reports_per_key": round(statistics.mean(
+                math.ceil(size / deck.IMAGE_REPORT_PAYLOAD_LENGTH) for size in sizes), 2),
+            "psnr_db": round(10 * math.log10(255 ** 2 / mse), 1) if mse else None,
+        }
+
+    orient = daemon.NativeEncoder(deck).orient
+    results = {"keys": len(images),
+               "default": f"{default.quality} {default.subsampling}",
+               "pilhelper": measure(lambda image: PILHelper.to_native_format(deck, image), orient)}
+    for quality, subsampling in ENCODE_SETTINGS:
+        encoder = daemon.NativeEncoder(deck, daemon.EncodeSettings(quality, subsampling))
+        results[f"{quality} {subsampling}"] = measure(encoder.encode, orient)
+    return results
+
+
+def bench_press(session: BenchSession, count: int) -> dict:
+    """Press-to-pixel: key callback until the pressed key's image reaches USB."""
+    deck = session.deck
+    latencies, misses = [], 0
+    for i in range(count):
+        key = i % len(LIGHTS)
+        start = time.perf_counter()
+        deck.press(key, True)
+        written = deck.wait_for_write(key, start)
+        deck.press(key, False)
+        if written is None:
+            misses += 1
+        else:
+            latencies.append(written - start)
+        deck.wait_idle()
+    return {
+        "usb_latency_ms": deck.usb_latency * 1e3,
+        "press_to_pixel_ms": _summary(latencies),
+        "missed": misses,
+        "service_calls": len(session.server.calls),
+    }
+
+
+def bench_events(session: BenchSession, count: int, rate: float | None) -> dict:
+    """CPU per 1k state changes for a watched sensor shown on the deck."""
+    session.counter.expect(count)
+    cpu_before = session.thread_cpu()
+    writes_before = len(session.deck.writes)
+    start = time.perf_counter()
+    session.server.replay(SENSOR, count, rate)
+    session.counter.done.wait(max(30.0, count / (rate or 1000) * 2))
+    elapsed = time.perf_counter() - start
+    session.deck.wait_idle()
+    cpu_after = session.thread_cpu()
+    per_1k = {name: round((cpu_after[name] - cpu_before[name]) / count * 1e6, 3)
+              for name in cpu_before}
+    return {
+        "events": count,
+        "delivered": session.counter.count,
+        "rate": rate,
+        "seconds": round(elapsed, 4),
+        "events_per_second": round(count / elapsed, 1),
+        "cpu_ms_per_1k": per_1k,
+        "key_writes": len(session.deck.writes) - writes_before,
+    }
+
+
+def bench_reconnect(session: BenchSession, count: int) -> dict:
+    """Drop the connection; time until the daemon is subscribed and up to date again."""
+    resubscribed, refreshed, failed = [], [], 0
+    for _ in range(count):
+        session.counter.expect(1)
+        start = time.perf_counter()
+        session.server.drop_connections()
+        if not session.server.subscribed.wait(30) or not session.counter.done.wait(5):
+            failed += 1
+            continue
+        resubscribed.append(session.server.subscribe_times[-1] - start)
+        refreshed.append(time.perf_counter() - start)
+    return {
+        "drops": count,
+        "failed": failed,
+        "resubscribe_ms": _summary(resubscribed),
+        "state_refresh_ms": _summary(refreshed),
+        "backoff_min_s": session.daemon.RECONNECT_MIN_DELAY,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    sub = parser.add_subparsers(dest="bench", required=True)
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--output", type=Path, help="also write the JSON results here")
+    usb = argparse.ArgumentParser(add_help=False)
+    usb.add_argument("--usb-latency", type=float, default=0.002, help="seconds per USB write")
+
+    p = sub.add_parser("decode", parents=[common], help="WS frame decoding: json.loads vs the daemon's decoder")
+    p.add_argument("--frames", type=Path, help="recorded frames (STREAMDECK_WS_RECORD output)")
+    p.add_argument("--count", type=int, default=50000, help="synthetic frames if no recording")
+
+    p = sub.add_parser("render", parents=[common], help="render throughput, cold and cached")
+    p.add_argument("--count", type=int, default=500)
+
+    p = sub.add_parser("composite", parents=[common], help="full-page renders, per key vs one deck canvas")
+    p.add_argument("--count", type=int, default=200)
+
+    p = sub.add_parser("encode", parents=[common], help="JPEG quality/subsampling: encode time, USB size, PSNR")
+    p.add_argument("--count", type=int, default=50)
+
+    p = sub.add_parser("press", parents=[common, usb], help="press-to-pixel latency on a fake deck")
+    p.add_argument("--count", type=int, default=200)
+
+    p = sub.add_parser("events", parents=[common, usb], help="CPU per 1k HA state changes")
+    p.add_argument("--count", type=int, default=5000)
+    p.add_argument("--rate", type=float, help="events per second (default: as fast as possible)")
+
+    p = sub.add_parser("reconnect", parents=[common, usb], help="recovery time after the HA connection drops")
+    p.add_argument("--count", type=int, default=5)
+
+    p = sub.add_parser("all", parents=[common, usb], help="run every benchmark with defaults")
+
+    args = parser.parse_args()
+    # Daemon log lines go to stderr so stdout stays pure JSON
+    out, sys.stdout = sys.stdout, sys.stderr
+    daemon = load_daemon()
+    results = {}
+
+    if args.bench in ("decode", "all"):
+        frames = load_frames(getattr(args, "frames", None), getattr(args, "count", 50000))
+        results["decode"] = bench_decode(daemon, frames)
+    if args.bench in ("render", "all"):
+        results["render"] = bench_render(daemon, args.count if args.bench == "render" else 500)
+    if args.bench in ("composite", "all"):
+        results["composite"] = bench_composite(daemon, args.count if args.bench == "composite" else 200)
+    if args.bench in ("encode", "all"):
+        results["encode"] = bench_encode(daemon, args.count if args.bench == "encode" else 50)
+    if args.bench in ("press", "events", "reconnect", "all"):
+        prepare_daemon(daemon)
+        with BenchSession(daemon, args.usb_latency) as session:
+            if args.bench in ("press", "all"):
+                results["press"] = bench_press(session, args.count if args.bench == "press" else 200)
+            if args.bench in ("events", "all"):
+                results["events"] = bench_events(
+                    session, args.count if args.bench == "events" else 5000, getattr(args, "rate", None))
+            if args.bench in ("reconnect", "all"):
+                results["reconnect"] = bench_reconnect(
+                    session, args.count if args.bench == "reconnect" else 5)
+
+    report = {
+        "python": platform.python_version(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        **results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        args.output.write_text(text + "\n")
+    print(text, file=out)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,35 +4,156 @@ Custom StreamDeck daemon with Home Assistant integration.
 Replaces streamdeck-ui with direct hardware control and real-time HA updates.
 """
 
+from __future__ import annotations
+
 import asyncio
+import bisect
+import codecs
+import copy
+import ctypes
+import ctypes.util
+import functools
+import hashlib
+import inspect
+import io
 import json
+import os
+import random
+import shlex
+import shutil
 import signal
-import subprocess
+import struct
 import sys
 import threading
 import time
+import tomllib
+from array import array
+from collections import OrderedDict, deque
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
 from pathlib import Path
+from types import MappingProxyType
+from typing import Any
 
-from PIL import Image, ImageDraw, ImageFont
 from StreamDeck.DeviceManager import DeviceManager
-from StreamDeck.ImageHelpers import PILHelper
 
-import aiohttp
+try:
+    import orjson  # Optional: ~3-5x faster than json.loads on HA frames
+except ImportError:
+    orjson = None
+
+# PIL and the StreamDeck image helpers load on the first render (_import_pil),
+# so a start served from the render cache never imports them; aiohttp loads
+# in ha_websocket_loop, after the decks are painted.
+Image = ImageDraw = ImageFont = PILHelper = None
+
+
+def _import_pil():
+    global Image, ImageDraw, ImageFont, PILHelper
+    if PILHelper is None:
+        from PIL import Image, ImageDraw, ImageFont
+        from StreamDeck.ImageHelpers import PILHelper
 
 # === Configuration ===
 
 HA_URL = "wss://ha.miker.be/api/websocket"
 HA_TOKEN_FILE = Path.home() / ".config/home-assistant/token"
+CACHE_DIR = Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "streamdeck-daemon"
 ICONS_DIR = Path.home() / "nixos-config/config/streamdeck/icons"
+# Button layout (TOML or JSON); reloaded on SIGHUP
+LAYOUT_FILE = Path(os.environ.get("STREAMDECK_LAYOUT",
+                                  Path.home() / "nixos-config/config/streamdeck/layout.toml"))
 
 # Font for button text (fallback to default if not found)
 FONT_PATH = None  # Resolved at startup via fc-match
 FONT_SIZE = 14
 FONT_SIZE_SMALL = 12
 
+# How often to look for plugged / unplugged decks
+HOTPLUG_POLL_INTERVAL = 2.0
+
 # Screensaver settings
 SCREENSAVER_DIM_TIMEOUT = 150    # 2.5 minutes - dim to 30%
 SCREENSAVER_OFF_TIMEOUT = 300    # 5 minutes - screen off
+SCREENSAVER_DIM_LEVEL = 30
+SCREENSAVER_FADE_TIME = 0.8      # seconds for a dim/off fade
+SCREENSAVER_FADE_STEPS = 4       # set_brightness writes per fade
+# Write black images when the screen goes off, so static images don't wear the
+# LCD. Waking rewrites only the keys not black already, from the framebuffers.
+# False just turns the backlight off and leaves the images on the deck.
+SCREENSAVER_BLANK_KEYS = True
+
+# Rendered key images kept in memory (native format, per deck type)
+RENDER_CACHE_SIZE = 256
+# ... and on disk, keyed by content hash, so restarts skip unchanged renders.
+# Each version of the daemon writes its own subdirectory; at startup the
+# others are deleted and only the most recently used files are kept.
+RENDER_CACHE_DIR = CACHE_DIR / "render"
+RENDER_DISK_CACHE_SIZE = 2048
+# Resolved font path and icon hashes, so a restart skips fc-match and rehashing
+STARTUP_MANIFEST = CACHE_DIR / "startup.json"
+
+# Key image encoding, unless the layout's [encoding] table says otherwise. On
+# 72-96px keys 4:4:4 chroma keeps coloured text sharp, and quality 95 is
+# smaller than PILHelper's quality=100 with 4:2:0 (fewer USB reports per key).
+JPEG_QUALITY = 95
+JPEG_SUBSAMPLING = "4:4:4"
+JPEG_SUBSAMPLINGS = ("4:4:4", "4:2:2", "4:2:0")
+
+# Shortest frame of an animated page background (seconds)
+ANIMATION_MIN_FRAME_TIME = 0.1
+
+# Icon sizes used by the button renderers, resized once when an icon is first drawn
+ICON_SIZES = (64, 48, 32)
+# Rasterized text lines kept for reuse (label text is drawn far more often than it changes)
+TEXT_CACHE_SIZE = 256
+
+# Service calls held while HA is disconnected (oldest dropped first)
+COMMAND_QUEUE_SIZE = 32
+# Command keys: seconds before a command is killed, presses queued behind a running one
+COMMAND_TIMEOUT = 30.0
+COMMAND_QUEUE_LIMIT = 4
+# Volume presses within this window collapse into one volume_set
+VOLUME_COALESCE_WINDOW = 0.3
+# Volume change per press (Sonos volume_up/volume_down step)
+VOLUME_STEP = 0.02
+# Gestures: a key held this long fires its long_press, a second tap within the
+# window its double_tap. Held repeat keys step again after REPEAT_DELAY, every
+# REPEAT_INTERVAL shrinking by REPEAT_ACCELERATION per step down to the minimum.
+LONG_PRESS_TIME = 0.5
+DOUBLE_TAP_WINDOW = 0.3
+REPEAT_DELAY = 0.4
+REPEAT_INTERVAL = 0.25
+REPEAT_MIN_INTERVAL = 0.06
+REPEAT_ACCELERATION = 0.85
+# Reconnect backoff: fast first retry, doubling up to the cap, with jitter
+RECONNECT_MIN_DELAY = 0.5
+RECONNECT_MAX_DELAY = 60.0
+# After HA rejects the token, retrying it would only count towards HA's
+# ip_ban; instead the token file is checked this often for a new token.
+AUTH_RETRY_POLL = 10
+
+# Last known entity states, painted at startup before HA connects
+ENTITY_SNAPSHOT = CACHE_DIR / "entities.json"
+SNAPSHOT_INTERVAL = 30  # seconds between snapshot writes (only if changed)
+
+# Optimistic button states roll back if HA hasn't confirmed them by then
+OPTIMISTIC_TIMEOUT = 5.0
+
+# Sensor tiles: samples kept per entity, pixels per sample, and minimum
+# seconds between redraws of one tile (chatty sensors coalesce)
+SENSOR_HISTORY_SIZE = 256
+SPARKLINE_STEP = 2
+SENSOR_TILE_MIN_INTERVAL = 5.0
+
+# Prometheus metrics endpoint (localhost only); SIGUSR1 dumps a summary to the journal
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = int(os.environ.get("STREAMDECK_METRICS_PORT", "9788"))
+
+# Set to a file path to record raw WS text frames (one per line) for streamdeck-bench.py
+WS_RECORD_FILE = os.environ.get("STREAMDECK_WS_RECORD")
 
 
 def _find_font() -> str:
@@ -50,110 +171,1835 @@ def _find_font() -> str:
     return ""
 
 
-def get_ha_token() -> str:
-    if not HA_TOKEN_FILE.exists():
-        print(f"ERROR: Token file missing: {HA_TOKEN_FILE}", file=sys.stderr)
-        sys.exit(1)
-    return HA_TOKEN_FILE.read_text().strip()
+def _process_age() -> float | None:
+    """Seconds since this process started (from /proc/self/stat), for startup timing."""
+    try:
+        with open("/proc/self/stat") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        return time.clock_gettime(time.CLOCK_BOOTTIME) - start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+def get_ha_token() -> str | None:
+    """The HA access token, or None if the token file is missing, unreadable or empty."""
+    try:
+        return HA_TOKEN_FILE.read_text().strip() or None
+    except OSError:
+        return None
+
+
+# === Metrics ===
+# Latency histograms and counters for the hot paths, so lag can be pinned
+# on PIL, USB writes or HA. Served in Prometheus text format and dumped on
+# SIGUSR1.
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+class Histogram:
+    """Cumulative-bucket latency histogram (seconds)."""
+
+    def __init__(self, name: str, help_text: str, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += seconds
+            self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-quantile (inf if beyond the last bucket)."""
+        with self._lock:
+            target = q * self.count
+            seen = 0
+            for bound, count in zip((*self.buckets, float("inf")), self.counts):
+                seen += count
+                if seen >= target and self.count:
+                    return bound
+        return 0.0
+
+
+class Metrics:
+    """Registry of histograms, counters and gauges."""
+
+    def __init__(self):
+        self.histograms: dict[str, Histogram] = {}
+        self.counters: dict[str, list] = {}   # name -> [help, value, read or None]
+        self.gauges: dict[str, tuple] = {}    # name -> (help, callable)
+        self._lock = threading.Lock()
+
+    def histogram(self, name: str, help_text: str) -> Histogram:
+        self.histograms[name] = Histogram(name, help_text)
+        return self.histograms[name]
+
+    def counter(self, name: str, help_text: str, read=None):
+        """A monotonic total, kept here (see inc()) or read from its owner by read()."""
+        self.counters[name] = [help_text, 0, read]
+
+    def gauge(self, name: str, help_text: str, read):
+        self.gauges[name] = (help_text, read)
+
+    def inc(self, name: str, amount: int = 1):
+        with self._lock:
+            self.counters[name][1] += amount
+
+    def observe(self, name: str, seconds: float):
+        self.histograms[name].observe(seconds)
+
+    @contextmanager
+    def timer(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.histograms[name].observe(time.perf_counter() - start)
+
+    def prometheus(self) -> str:
+        lines = []
+        for h in self.histograms.values():
+            lines += [f"# HELP {h.name} {h.help}", f"# TYPE {h.name} histogram"]
+            with h._lock:
+                cumulative = 0
+                for bound, count in zip(h.buckets, h.counts):
+                    cumulative += count
+                    lines.append(f'{h.name}_bucket{{le="{bound}"}} {cumulative}')
+                lines.append(f'{h.name}_bucket{{le="+Inf"}} {h.count}')
+                lines.append(f"{h.name}_sum {h.sum}")
+                lines.append(f"{h.name}_count {h.count}")
+        for name, (help_text, value, read) in self.counters.items():
+            value = read() if read else value
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter", f"{name} {value}"]
+        for name, (help_text, read) in self.gauges.items():
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {read()}"]
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        lines = ["metrics:"]
+        for h in self.histograms.values():
+            mean = h.sum / h.count * 1000 if h.count else 0.0
+            lines.append(f"  {h.name}: n={h.count} mean={mean:.2f}ms "
+                         f"p50<={h.quantile(0.5) * 1000:g}ms p99<={h.quantile(0.99) * 1000:g}ms")
+        for name, (_, value, read) in self.counters.items():
+            lines.append(f"  {name}: {read() if read else value}")
+        for name, (_, read) in self.gauges.items():
+            lines.append(f"  {name}: {read()}")
+        return "\n".join(lines)
+
+
+_metrics = Metrics()
+_metrics.histogram("streamdeck_key_press_seconds", "Key callback to on_press() return")
+_metrics.histogram("streamdeck_render_seconds", "Button.render() (PIL drawing)")
+_metrics.histogram("streamdeck_native_encode_seconds", "NativeEncoder.encode() (orientation + JPEG/BMP)")
+_metrics.histogram("streamdeck_set_key_image_seconds", "USB set_key_image() write")
+_metrics.histogram("streamdeck_ha_call_seconds", "Service call sent to HA result received")
+_metrics.histogram("streamdeck_ws_decode_seconds", "WS text frame decode")
+_metrics.counter("streamdeck_ws_messages_total", "WS text frames received")
+_metrics.counter("streamdeck_ws_messages_dropped_total",
+                 "WS frames dropped as irrelevant (neither the subscription nor a pending call)")
+_metrics.counter("streamdeck_ha_reconnects_total", "HA WS connection attempts after the first")
+_metrics.counter("streamdeck_key_writes_skipped_total", "set_key_image() skipped, key already shows the image")
+_metrics.counter("streamdeck_long_presses_total", "Long presses recognized")
+_metrics.counter("streamdeck_double_taps_total", "Double taps recognized")
+_metrics.counter("streamdeck_key_repeats_total", "Repeat steps fired by held keys")
+
+
+async def metrics_server():
+    """Serve /metrics in Prometheus text format on METRICS_HOST:METRICS_PORT."""
+    from aiohttp import web
+
+    async def handle(request):
+        return web.Response(text=_metrics.prometheus(), content_type="text/plain")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    except OSError as e:
+        print(f"Metrics endpoint disabled: {e}", file=sys.stderr, flush=True)
+        await runner.cleanup()
+        return
+    print(f"Metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics", flush=True)
+    try:
+        await asyncio.Event().wait()  # Hold the runner until shutdown cancels us
+    finally:
+        await runner.cleanup()
 
 
 # === WS Command Queue ===
-# Button presses from the StreamDeck callback thread put service calls here.
-# The async WS loop drains and sends them over the open connection.
-_ws_queue: asyncio.Queue | None = None
-_ws_loop: asyncio.AbstractEventLoop | None = None
+# Button presses put service calls here, even while HA is disconnected.
+# The async WS loop drains and sends them over the open connection and
+# reports each call's result back to the button that made it.
+
+class CommandQueue:
+    """Bounded, thread-safe service-call queue with volume-step coalescing."""
+
+    def __init__(self, maxsize: int = COMMAND_QUEUE_SIZE):
+        self.dropped = 0
+        self._pending: deque[dict] = deque(maxlen=maxsize)
+        self._lock = threading.Lock()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._ready: asyncio.Event | None = None
+        # entity_id -> accumulated volume delta waiting for the coalesce window
+        self._volume_deltas: dict[str, float] = {}
+        # entity_id -> (level, monotonic time) of the last volume_set we sent
+        self._volume_sent: dict[str, tuple[float, float]] = {}
+
+    def attach(self, loop: asyncio.AbstractEventLoop):
+        """Bind to the WS event loop; called once from ha_websocket_loop."""
+        self._loop = loop
+        self._ready = asyncio.Event()
+        if self._pending:
+            self._ready.set()
+
+    def put(self, cmd: dict):
+        with self._lock:
+            if len(self._pending) == self._pending.maxlen:
+                dropped = self._pending[0]
+                self.dropped += 1
+                _report_result(dropped, False, "dropped: queue full while disconnected")
+            self._pending.append(cmd)
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._ready.set)
+
+    async def get(self) -> dict:
+        while True:
+            with self._lock:
+                if self._pending:
+                    return self._pending.popleft()
+                self._ready.clear()
+            await self._ready.wait()
+
+    def step_volume(self, entity_id: str, delta: float, on_result=None):
+        """Accumulate a volume step; one volume_set is sent per coalesce window."""
+        with self._lock:
+            first = entity_id not in self._volume_deltas
+            self._volume_deltas[entity_id] = self._volume_deltas.get(entity_id, 0.0) + delta
+        if not first:
+            return
+        if self._loop is None:
+            self._flush_volume(entity_id, on_result)
+        else:
+            self._loop.call_soon_threadsafe(
+                self._loop.call_later, VOLUME_COALESCE_WINDOW, self._flush_volume, entity_id, on_result)
 
+    def _flush_volume(self, entity_id: str, on_result):
+        with self._lock:
+            delta = self._volume_deltas.pop(entity_id, 0.0)
+        if not delta:
+            return
+
+        # Base on the level we last sent if HA hasn't caught up yet
+        level = None
+        sent = self._volume_sent.get(entity_id)
+        if sent and time.monotonic() - sent[1] < 2.0:
+            level = sent[0]
+        else:
+            state = _entities.get(entity_id)
+            if state:
+                level = state.get("attributes", {}).get("volume_level")
+
+        if level is None:
+            # Unknown current level: fall back to discrete steps
+            service = "volume_up" if delta > 0 else "volume_down"
+            for _ in range(max(1, round(abs(delta) / VOLUME_STEP))):
+                self.put(_service_call("media_player", service, on_result, entity_id=entity_id))
+            return
 
-def call_ha_service(domain: str, service: str, **service_data):
+        target = round(min(1.0, max(0.0, level + delta)), 2)
+        self._volume_sent[entity_id] = (target, time.monotonic())
+        self.put(_service_call("media_player", "volume_set", on_result,
+                               entity_id=entity_id, volume_level=target))
+
+
+def _service_call(domain: str, service: str, on_result=None, **service_data) -> dict:
+    return {"domain": domain, "service": service, "service_data": service_data, "on_result": on_result}
+
+
+def _report_result(cmd: dict, success: bool, error=None):
+    """Deliver a service call outcome to the caller's on_result(success, error)."""
+    if not success:
+        print(f"HA {cmd['domain']}.{cmd['service']} failed: {error}", flush=True)
+    if cmd.get("on_result"):
+        try:
+            cmd["on_result"](success, error)
+        except Exception as e:
+            print(f"Result callback error: {e}", file=sys.stderr, flush=True)
+
+
+_commands = CommandQueue()
+_metrics.gauge("streamdeck_command_queue_depth", "Service calls waiting to be sent",
+               lambda: len(_commands._pending))
+_metrics.counter("streamdeck_command_queue_dropped_total", "Service calls dropped while disconnected",
+                 lambda: _commands.dropped)
+# The daemon's one event loop (set by daemon()); everything but USB I/O runs on it
+_loop: asyncio.AbstractEventLoop | None = None
+_ws_resubscribe: asyncio.Event | None = None
+
+
+def request_ha_resubscribe():
+    """Resubscribe on the open WS so it covers a changed set of watched entities."""
+    if _ws_resubscribe is not None:
+        _ws_resubscribe.set()
+
+
+def call_later(delay: float, callback, *args):
+    """Run callback(*args) on the event loop after delay seconds."""
+    if _loop is not None:
+        _loop.call_later(delay, callback, *args)
+
+
+def call_ha_service(domain: str, service: str, on_result=None, **service_data):
     """Queue a service call to be sent over the WS connection."""
-    if _ws_loop and _ws_queue is not None:
-        _ws_loop.call_soon_threadsafe(
-            _ws_queue.put_nowait,
-            {"domain": domain, "service": service, "service_data": service_data},
+    _commands.put(_service_call(domain, service, on_result, **service_data))
+
+
+# === Command Runner ===
+# CommandButton commands run as asyncio subprocesses on the event loop, which
+# reaps every child. Simple commands are exec'd without a shell; playerctl
+# transport commands go to a persistent MPRIS client instead of a process.
+
+# Characters that need a shell (# may start a comment); anything else is
+# split with shlex and exec'd, unless it starts with VAR=value or a builtin
+_SHELL_CHARS = frozenset("|&;<>()$`*?[]~{}#!\n")
+_SHELL_BUILTINS = frozenset({".", "alias", "cd", "eval", "exec", "exit", "export",
+                             "set", "source", "ulimit", "umask", "unset"})
+
+
+def _exec_argv(command: str) -> list[str] | None:
+    """The argv to exec command directly, or None if it needs /bin/sh."""
+    if _SHELL_CHARS & set(command):
+        return None
+    try:
+        argv = shlex.split(command)
+    except ValueError:  # Unbalanced quotes: let the shell report it
+        return None
+    if not argv or "=" in argv[0] or argv[0] in _SHELL_BUILTINS:
+        return None
+    return argv
+
+
+class MprisClient:
+    """playerctl-style transport control over one persistent session-bus connection.
+
+    watch() follows the players' PropertiesChanged signals on the same
+    connection and publishes the active player as the local.media entity.
+    """
+
+    METHODS = {"play-pause": "PlayPause", "play": "Play", "pause": "Pause",
+               "next": "Next", "previous": "Previous", "stop": "Stop"}
+    PATH = "/org/mpris/MediaPlayer2"
+    PLAYER = "org.mpris.MediaPlayer2.Player"
+
+    def __init__(self):
+        self._bus = None
+        self.available = True  # False once dbus-next or the session bus turned out missing
+        # bus name -> {"owner", "status", "since", "title", "artist"} (loop thread only)
+        self._players: dict[str, dict] = {}
+
+    def handles(self, argv: list[str]) -> bool:
+        return self.available and len(argv) == 2 and argv[0] == "playerctl" and argv[1] in self.METHODS
+
+    async def bus(self):
+        """The session bus connection, (re)connected on demand; None if unavailable."""
+        if self._bus is not None and self._bus.connected:
+            return self._bus
+        try:
+            from dbus_next.aio import MessageBus
+            self._bus = await MessageBus().connect()
+        except Exception as e:
+            print(f"MPRIS unavailable ({e}), using playerctl", flush=True)
+            self.available = False
+            self._bus = None
+        return self._bus
+
+    async def call(self, destination: str, path: str, interface: str, member: str,
+                   signature: str = "", body: list | None = None):
+        """Method call on the session bus; returns the reply body or raises RuntimeError."""
+        bus = await self.bus()
+        if bus is None:
+            raise RuntimeError("no session bus")
+        from dbus_next import Message, MessageType
+        reply = await bus.call(Message(destination=destination, path=path, interface=interface,
+                                       member=member, signature=signature, body=body or []))
+        if reply.message_type == MessageType.ERROR:
+            raise RuntimeError(f"{reply.error_name}: {reply.body[0] if reply.body else ''}")
+        return reply.body
+
+    async def players(self) -> list[str]:
+        """MPRIS bus names, the playing ones first."""
+        (names,) = await self.call("org.freedesktop.DBus", "/org/freedesktop/DBus",
+                                   "org.freedesktop.DBus", "ListNames")
+        players = sorted(name for name in names if name.startswith("org.mpris.MediaPlayer2."))
+        playing = []
+        for name in players:
+            try:
+                (status,) = await self.call(name, self.PATH, "org.freedesktop.DBus.Properties", "Get",
+                                            "ss", [self.PLAYER, "PlaybackStatus"])
+            except RuntimeError:
+                continue
+            if status.value == "Playing":
+                playing.append(name)
+        return playing + [name for name in players if name not in playing]
+
+    async def run(self, argv: list[str]) -> str | None:
+        """Send a transport command to the active player; None on success, else the error."""
+        players = await self.players()
+        if not players:
+            return "no MPRIS player running"
+        await self.call(players[0], self.PATH, self.PLAYER, self.METHODS[argv[1]])
+        return None
+
+    async def watch(self):
+        """Keep local.media up to date from player signals; reconnects if the bus drops."""
+        dbus = ("org.freedesktop.DBus", "/org/freedesktop/DBus", "org.freedesktop.DBus")
+        rules = (
+            f"type='signal',interface='org.freedesktop.DBus.Properties',"
+            f"member='PropertiesChanged',path='{self.PATH}'",
+            "type='signal',sender='org.freedesktop.DBus',member='NameOwnerChanged',"
+            "arg0namespace='org.mpris.MediaPlayer2'",
         )
+        while self.available:
+            bus = await self.bus()
+            if bus is None:
+                return
+            try:
+                bus.add_message_handler(self._on_message)
+                for rule in rules:
+                    await self.call(*dbus, "AddMatch", "s", [rule])
+                (names,) = await self.call(*dbus, "ListNames")
+                self._players.clear()
+                for name in names:
+                    if name.startswith("org.mpris.MediaPlayer2."):
+                        await self._add_player(name)
+                self._publish()
+            except RuntimeError as e:
+                print(f"MPRIS watch failed: {e}", file=sys.stderr, flush=True)
+            await bus.wait_for_disconnect()
+            await asyncio.sleep(5)
+
+    async def _add_player(self, name: str, owner: str | None = None):
+        try:
+            if owner is None:
+                (owner,) = await self.call("org.freedesktop.DBus", "/org/freedesktop/DBus",
+                                           "org.freedesktop.DBus", "GetNameOwner", "s", [name])
+            (props,) = await self.call(name, self.PATH, "org.freedesktop.DBus.Properties",
+                                       "GetAll", "s", [self.PLAYER])
+        except RuntimeError:
+            return  # Gone again, or not a real player
+        player = {"owner": owner, "status": "Stopped", "since": 0.0, "title": "", "artist": ""}
+        self._update_player(player, props)
+        self._players[name] = player
+
+    def _update_player(self, player: dict, props: dict):
+        if "PlaybackStatus" in props:
+            player["status"] = props["PlaybackStatus"].value
+            player["since"] = time.monotonic()
+        if "Metadata" in props:
+            metadata = props["Metadata"].value
+            title, artist = metadata.get("xesam:title"), metadata.get("xesam:artist")
+            player["title"] = title.value if title else ""
+            player["artist"] = ", ".join(artist.value) if artist else ""
+
+    def _on_message(self, msg):
+        from dbus_next import MessageType
+        if msg.message_type != MessageType.SIGNAL:
+            return
+        if msg.member == "NameOwnerChanged":
+            name, _, new_owner = msg.body
+            if not name.startswith("org.mpris.MediaPlayer2."):
+                return
+            if new_owner:
+                async def add():
+                    await self._add_player(name, new_owner)
+                    self._publish()
+                asyncio.ensure_future(add())
+            elif self._players.pop(name, None) is not None:
+                self._publish()
+        elif msg.member == "PropertiesChanged" and msg.body and msg.body[0] == self.PLAYER:
+            for player in self._players.values():
+                if player["owner"] == msg.sender:
+                    self._update_player(player, msg.body[1])
+                    self._publish()
+
+    def _publish(self):
+        """The playing player, else the one that changed last, as local.media."""
+        if not self._players:
+            publish_local("local.media", "idle", {})
+            return
+        name, player = max(self._players.items(),
+                           key=lambda item: (item[1]["status"] == "Playing", item[1]["since"]))
+        publish_local("local.media", player["status"].lower(), {
+            "player": name.removeprefix("org.mpris.MediaPlayer2."),
+            "title": player["title"],
+            "artist": player["artist"],
+        })
+
+
+_mpris = MprisClient()
+
+
+class CommandRunner:
+    """Runs button commands with a per-button policy for presses while one is running.
+
+    "single" ignores the press, "queue" runs it after the current one, and
+    "restart" kills the running command (its whole process group) first.
+    """
+
+    def __init__(self):
+        self._tasks: dict[object, asyncio.Task] = {}  # owner -> its latest run (loop thread only)
+        self._queued: dict[object, int] = {}
+
+    def submit(self, owner, command: str, policy: str = "queue",
+               timeout: float = COMMAND_TIMEOUT, on_result=None):
+        """Run command for owner; on_result(success, error) gets the outcome."""
+        previous = self._tasks.get(owner)
+        if previous is not None and not previous.done():
+            if policy == "single":
+                return
+            if policy == "restart":
+                previous.cancel()
+            elif self._queued.get(owner, 0) >= COMMAND_QUEUE_LIMIT:
+                return
+            self._queued[owner] = self._queued.get(owner, 0) + 1
+        else:
+            previous = None
+        self._tasks[owner] = asyncio.get_running_loop().create_task(
+            self._run(owner, command, timeout, on_result, previous))
+
+    async def _run(self, owner, command: str, timeout: float, on_result, previous):
+        if previous is not None:
+            # Queued behind, or waiting for a cancelled run to finish killing
+            try:
+                await asyncio.wait([previous])
+            finally:
+                self._queued[owner] -= 1
+        try:
+            error = await asyncio.wait_for(self._execute(command), timeout)
+        except asyncio.TimeoutError:
+            error = f"timed out after {timeout:g}s"
+        except OSError as e:
+            error = str(e)
+        if error:
+            print(f"Command failed ({error}): {command}", file=sys.stderr, flush=True)
+        if on_result:
+            on_result(error is None, error)
+
+    async def _execute(self, command: str) -> str | None:
+        """Run one command to completion; None on success, else an error message."""
+        argv = _exec_argv(command)
+        if argv and _mpris.handles(argv):
+            try:
+                return await _mpris.run(argv)
+            except RuntimeError as e:
+                print(f"MPRIS call failed ({e}), using playerctl", flush=True)
+
+        options = dict(stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.DEVNULL,
+                       stderr=asyncio.subprocess.PIPE, start_new_session=True)
+        if argv:
+            proc = await asyncio.create_subprocess_exec(*argv, **options)
+        else:
+            proc = await asyncio.create_subprocess_shell(command, **options)
+        try:
+            _, stderr = await proc.communicate()
+        except BaseException:
+            # Timeout or restart: take down the whole pipeline, then reap it
+            for sig in (signal.SIGTERM, signal.SIGKILL):
+                try:
+                    os.killpg(proc.pid, sig)
+                except ProcessLookupError:
+                    break
+                try:
+                    await asyncio.wait_for(proc.wait(), 2.0)
+                    break
+                except asyncio.TimeoutError:
+                    pass
+            raise
+        if proc.returncode != 0:
+            lines = stderr.decode(errors="replace").strip().splitlines()
+            return lines[-1] if lines else f"exit status {proc.returncode}"
+        return None
+
+
+_runner = CommandRunner()
+
+
+# === Render Cache ===
+# Native-format key images keyed by visual state, so press flashes and
+# recurring HA states are served from memory instead of re-rasterized.
+
+class RenderCache:
+    """Bounded LRU cache of native key images with hit/miss counters.
+
+    Entries that come with a content hash are also persisted under disk_dir,
+    so a restart with an unchanged layout reads images instead of rendering.
+    prune_disk() bounds that to disk_maxsize files.
+    """
+
+    def __init__(self, maxsize: int = RENDER_CACHE_SIZE, disk_dir: Path | None = None,
+                 disk_maxsize: int = RENDER_DISK_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.disk_dir = disk_dir
+        self.disk_maxsize = disk_maxsize
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict[tuple, bytes] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_render(self, key: tuple, render_fn, content_hash: str | None = None) -> bytes | None:
+        """Return cached image for key, calling render_fn() on a miss."""
+        data = self.get(key, content_hash)
+        if data is None:
+            data = render_fn()
+            if data is None:
+                return None
+            self.put(key, data, content_hash)
+        return data
+
+    def get(self, key: tuple, content_hash: str | None = None) -> bytes | None:
+        """Cached image for key from memory or disk, or None (counted as a miss)."""
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return data
+
+        data = self._read_disk(content_hash)
+        if data is None:
+            self.misses += 1
+            return None
+        self.disk_hits += 1
+        self._insert(key, data)
+        return data
+
+    def put(self, key: tuple, data: bytes, content_hash: str | None = None):
+        """Store an image rendered after a miss (and on disk, with a content hash)."""
+        self._write_disk(content_hash, data)
+        self._insert(key, data)
+
+    def _insert(self, key: tuple, data: bytes):
+        with self._lock:
+            self._entries[key] = data
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def _read_disk(self, content_hash: str | None) -> bytes | None:
+        if not (self.disk_dir and content_hash):
+            return None
+        path = self.disk_dir / content_hash
+        try:
+            data = path.read_bytes()
+            os.utime(path)  # Recently used: survives prune_disk()
+        except OSError:
+            return None
+        return data
+
+    def _write_disk(self, content_hash: str | None, data: bytes):
+        if not (self.disk_dir and content_hash):
+            return
+        try:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+            tmp = self.disk_dir / f".{content_hash}.tmp"
+            tmp.write_bytes(data)
+            os.replace(tmp, self.disk_dir / content_hash)
+        except OSError as e:
+            print(f"Render cache write failed: {e}", file=sys.stderr, flush=True)
+
+    def prune_disk(self):
+        """Delete disk_dir's siblings (older daemon versions) and its least recently used files."""
+        if not (self.disk_dir and self.disk_dir.parent.is_dir()):
+            return
+        removed = 0
+        files = []
+        for entry in os.scandir(self.disk_dir.parent):
+            try:
+                if entry.path == str(self.disk_dir):
+                    files = [(f.stat().st_mtime_ns, f.path) for f in os.scandir(entry.path)]
+                elif entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path)
+                    removed += 1
+                else:
+                    os.unlink(entry.path)
+                    removed += 1
+            except OSError as e:
+                print(f"Render cache prune failed: {e}", file=sys.stderr, flush=True)
+        files.sort(reverse=True)
+        for _, path in files[self.disk_maxsize:]:
+            try:
+                os.unlink(path)
+                removed += 1
+            except OSError:
+                pass
+        if removed:
+            print(f"Render cache: pruned {removed} stale disk entries", flush=True)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def invalidate_icon(self, icon: str):
+        """Drop every entry rendered with the given icon path."""
+        with self._lock:
+            for key in [k for k in self._entries if icon in k]:
+                del self._entries[key]
+
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        rate = (self.hits / total * 100) if total else 0.0
+        return (f"render cache: {len(self._entries)}/{self.maxsize} entries, "
+                f"{self.hits} hits, {self.disk_hits} disk hits, {self.misses} misses "
+                f"({rate:.0f}% memory hit), {self.evictions} evictions")
+
+
+# Any change to this file (render code included) invalidates the on-disk renders
+_CODE_DIGEST = hashlib.sha256(Path(__file__).read_bytes()).digest()
+
+_render_cache = RenderCache(disk_dir=RENDER_CACHE_DIR / _CODE_DIGEST.hex()[:16])
+_metrics.counter("streamdeck_render_cache_hits_total", "Render cache memory hits", lambda: _render_cache.hits)
+_metrics.counter("streamdeck_render_cache_disk_hits_total", "Render cache disk hits",
+                 lambda: _render_cache.disk_hits)
+_metrics.counter("streamdeck_render_cache_misses_total", "Render cache misses", lambda: _render_cache.misses)
+
+
+# === Startup Manifest ===
+# Startup facts that are slow to find but cheap to check: the font fc-match
+# resolved (kept while the file exists) and every icon's content hash (kept
+# while its mtime and size match). With these and a warm render cache a
+# restart paints the decks without fc-match, icon decoding or PIL.
+
+class StartupManifest:
+    """The resolved font and icon hashes, saved as JSON between runs."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.font: str | None = None
+        self.icons: dict[str, list] = {}  # path -> [mtime_ns, size, sha256]
+        self._saved = None
+
+    def load(self):
+        try:
+            data = json.loads(self.path.read_bytes())
+            self.font = data.get("font")
+            self.icons = dict(data.get("icons", {}))
+        except (OSError, ValueError, AttributeError, TypeError):
+            pass
+        self._saved = self._data()
+
+    def save(self):
+        """Write the manifest if anything changed since it was loaded or saved."""
+        data = self._data()
+        if data == self._saved:
+            return
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_suffix(".tmp")
+            tmp.write_text(json.dumps(data))
+            os.replace(tmp, self.path)
+            self._saved = data
+        except OSError as e:
+            print(f"Startup manifest write failed: {e}", file=sys.stderr, flush=True)
+
+    def _data(self) -> dict:
+        return {"font": self.font, "icons": copy.deepcopy(self.icons)}
+
+    def resolve_font(self) -> str:
+        """The remembered font while its file exists, else _find_font()."""
+        if not (self.font and os.path.exists(self.font)):
+            self.font = _find_font() or None
+        return self.font or ""
+
+    def icon_digest(self, path: str) -> str:
+        """Content hash of an icon ("" if missing); the file is only read when it changed."""
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.icons.pop(path, None)
+            return ""
+        entry = self.icons.get(path)
+        if entry and entry[:2] == [st.st_mtime_ns, st.st_size]:
+            return entry[2]
+        try:
+            digest = hashlib.sha256(Path(path).read_bytes()).hexdigest()
+        except OSError:
+            return ""
+        self.icons[path] = [st.st_mtime_ns, st.st_size, digest]
+        return digest
+
+
+_manifest = StartupManifest(STARTUP_MANIFEST)
+
+
+# === Asset Store ===
+# Icons are decoded and resized on first use, then kept; fonts are loaded
+# once per size. Icon hashes come from the startup manifest. An inotify
+# watch on ICONS_DIR invalidates only the icon that changed.
+
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_DELETE = 0x00000200
+_IN_EVENT = struct.Struct("iIII")
+
+
+class AssetStore:
+    """Icon hashes, icons decoded and resized on first draw, fonts and text masks."""
+
+    def __init__(self, icons_dir: Path, sizes: tuple[int, ...] = ICON_SIZES):
+        self.icons_dir = icons_dir
+        self.sizes = sizes
+        self.on_change = None  # Called with the icon path after it is reloaded
+        self._icons: dict[str, dict[int, Image.Image] | None] = {}
+        self._digests: dict[str, str] = {}
+        self._fonts: dict[int, ImageFont.FreeTypeFont] = {}
+        self._texts: OrderedDict[tuple[str, int], tuple] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def preload(self):
+        """Hash every icon under icons_dir; decoding waits until an icon is drawn."""
+        for path in sorted(self.icons_dir.glob("*.png")):
+            self.digest(str(path))
+        # Forget icons that were removed from icons_dir
+        prefix = f"{self.icons_dir}{os.sep}"
+        for path in [p for p in _manifest.icons if p.startswith(prefix) and p not in self._digests]:
+            del _manifest.icons[path]
+        print(f"Assets: {len(self._digests)} icons", flush=True)
+
+    def _load_icon(self, path: str) -> dict[int, Image.Image] | None:
+        _import_pil()
+        try:
+            with Image.open(path) as src:
+                img = src.convert("RGBA")
+            variants = {
+                size: img.resize((size, size), Image.Resampling.LANCZOS)
+                for size in self.sizes
+            }
+        except (OSError, ValueError):
+            variants = None
+        with self._lock:
+            self._icons[path] = variants
+        return variants
+
+    def digest(self, path: str) -> str:
+        """Content hash of an icon file ("" if missing), for on-disk cache keys."""
+        if not path:
+            return ""
+        with self._lock:
+            if path in self._digests:
+                return self._digests[path]
+        digest = _manifest.icon_digest(path)
+        with self._lock:
+            self._digests[path] = digest
+        return digest
+
+    def icon(self, path: str, size: int) -> Image.Image | None:
+        """Return the icon at path resized to size x size, or None if unavailable."""
+        if not path:
+            return None
+        with self._lock:
+            loaded = path in self._icons
+            variants = self._icons.get(path)
+        if not loaded:
+            # First draw of this icon: decode and resize it once
+            variants = self._load_icon(path)
+        if variants is None:
+            return None
+        if size not in variants:
+            variants[size] = variants[self.sizes[0]].resize((size, size), Image.Resampling.LANCZOS)
+        return variants[size]
+
+    def font(self, size: int):
+        """Return the button font at the given size (default bitmap font as fallback)."""
+        font = self._fonts.get(size)
+        if font is None:
+            _import_pil()
+            try:
+                font = ImageFont.truetype(FONT_PATH, size)
+            except (OSError, AttributeError):
+                font = ImageFont.load_default()
+            self._fonts[size] = font
+        return font
+
+    def text(self, line: str, size: int) -> tuple[Image.Image, tuple[int, int, int, int]]:
+        """One line of text rasterized as an "L" mask, with its bounding box.
+
+        Drawing the mask with ImageDraw.bitmap at the box's top left gives the
+        same pixels as ImageDraw.text at the origin.
+        """
+        key = (line, size)
+        cached = self._texts.get(key)
+        if cached is not None:
+            self._texts.move_to_end(key)
+            return cached
+        font = self.font(size)
+        left, top, right, bottom = bbox = font.getbbox(line)
+        mask = Image.new("L", (max(right - left, 1), max(bottom - top, 1)))
+        ImageDraw.Draw(mask).text((-left, -top), line, font=font, fill=255)
+        cached = self._texts[key] = (mask, bbox)
+        while len(self._texts) > TEXT_CACHE_SIZE:
+            self._texts.popitem(last=False)
+        return cached
+
+    def invalidate(self, path: str):
+        """Drop one icon and notify the owner so affected keys redraw."""
+        with self._lock:
+            self._icons.pop(path, None)
+            self._digests.pop(path, None)
+        self.digest(path)
+        _render_cache.invalidate_icon(path)
+        if self.on_change:
+            self.on_change(path)
+
+    def watch(self, loop: asyncio.AbstractEventLoop):
+        """Watch icons_dir with inotify from the event loop (Linux only, best effort)."""
+        libc_name = ctypes.util.find_library("c")
+        if not libc_name:
+            return
+        try:
+            libc = ctypes.CDLL(libc_name, use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            return
+        if fd < 0:
+            return
+        mask = _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_DELETE
+        if libc.inotify_add_watch(fd, bytes(self.icons_dir), mask) < 0:
+            os.close(fd)
+            print(f"Icon watch failed on {self.icons_dir}", file=sys.stderr, flush=True)
+            return
+
+        def on_readable():
+            try:
+                buf = os.read(fd, 4096)
+            except BlockingIOError:
+                return
+            offset = 0
+            while offset < len(buf):
+                _wd, _mask, _cookie, length = _IN_EVENT.unpack_from(buf, offset)
+                offset += _IN_EVENT.size
+                name = buf[offset:offset + length].rstrip(b"\0").decode(errors="replace")
+                offset += length
+                if name.endswith(".png"):
+                    self.invalidate(str(self.icons_dir / name))
+
+        loop.add_reader(fd, on_readable)
+
+
+_assets = AssetStore(ICONS_DIR)
+
+
+# === Entity Store ===
+# Last known state of every entity a button watches. The HA loop feeds it
+# from a server-side filtered subscribe_entities stream; buttons subscribe
+# per entity and get update_entity() calls with HA-shaped state dicts.
+# Pseudo-entities under LOCAL_PREFIX (PipeWire, MPRIS) are fed by local
+# monitors the same way, but never subscribed to in HA or snapshotted.
+
+LOCAL_PREFIX = "local."
+
+class RingBuffer:
+    """Fixed-size float history in an array('d'); the oldest sample is overwritten."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self.total = 0  # Samples ever appended; also the write position
+        self._data = array("d", bytes(8 * size))
+        self._lock = threading.Lock()
+
+    def append(self, value: float):
+        with self._lock:
+            self._data[self.total % self.size] = value
+            self.total += 1
+
+    def append_state(self, state: dict):
+        """Append a state's numeric value; non-numeric states (unavailable...) are skipped."""
+        try:
+            self.append(float(state.get("state")))
+        except (TypeError, ValueError):
+            pass
+
+    def latest(self, count: int) -> tuple[list[float], int]:
+        """The newest count samples, oldest first, and the total they end at."""
+        with self._lock:
+            total = self.total
+            count = min(count, total, self.size)
+            start = (total - count) % self.size
+            if start + count <= self.size:
+                values = self._data[start:start + count].tolist()
+            else:
+                values = (self._data[start:] + self._data[:start + count - self.size]).tolist()
+        return values, total
+
+
+class EntityStore:
+    """Watched entity states, fanned out to the buttons that display them."""
+
+    def __init__(self):
+        self._states: dict[str, dict] = {}
+        self._subscribers: dict[str, list] = {}
+        self._groups: dict[str, list] = {}  # owner (deck serial) -> its buttons
+        self._lock = threading.Lock()
+        self._groups_lock = threading.Lock()
+        self._changed = False  # Since the last snapshot write
+        self._history: dict[str, RingBuffer] = {}  # numeric history of tracked entities
+
+    def set_subscribers(self, owner: str, buttons) -> bool:
+        """Replace one deck's subscribed buttons; True if the watched entity set changed."""
+        buttons = list(buttons)
+        with self._groups_lock:
+            self._groups[owner] = buttons
+            changed = self._rebuild()
+        # Bring the new buttons up to date with what is already known
+        for button in buttons:
+            for entity_id in button.watched_entities:
+                state = self.get(entity_id)
+                if state is not None:
+                    button.update_entity(entity_id, state)
+        return changed
+
+    def remove_subscribers(self, owner: str) -> bool:
+        """Forget a deck's buttons; True if the watched entity set changed."""
+        with self._groups_lock:
+            if self._groups.pop(owner, None) is None:
+                return False
+            return self._rebuild()
+
+    def _rebuild(self) -> bool:
+        subscribers: dict[str, list] = {}
+        for buttons in self._groups.values():
+            for button in buttons:
+                for entity_id in button.watched_entities:
+                    subscribers.setdefault(entity_id, []).append(button)
+        changed = ({e for e in subscribers if not e.startswith(LOCAL_PREFIX)}
+                   != {e for e in self._subscribers if not e.startswith(LOCAL_PREFIX)})
+        self._subscribers = subscribers  # Swapped whole; the HA loop never sees a partial map
+        return changed
+
+    def watched(self) -> list[str]:
+        """Watched HA entities (local pseudo-entities excluded)."""
+        return sorted(e for e in self._subscribers if not e.startswith(LOCAL_PREFIX))
+
+    def get(self, entity_id: str) -> dict | None:
+        with self._lock:
+            return self._states.get(entity_id)
+
+    def history(self, entity_id: str) -> RingBuffer:
+        """The numeric history of an entity, recorded from now on (seeded with its current state)."""
+        with self._lock:
+            history = self._history.get(entity_id)
+            if history is None:
+                history = self._history[entity_id] = RingBuffer(SENSOR_HISTORY_SIZE)
+                if entity_id in self._states:
+                    history.append_state(self._states[entity_id])
+        return history
+
+    def set(self, entity_id: str, state: dict):
+        """Store a full state object and notify subscribed buttons."""
+        with self._lock:
+            previous = self._states.get(entity_id)
+            self._states[entity_id] = state
+            self._changed = True
+            history = self._history.get(entity_id)
+            # A reconnect resends unchanged states; only new updates are samples
+            if history is not None and (previous is None
+                                        or previous.get("last_updated") != state.get("last_updated")):
+                history.append_state(state)
+        for button in self._subscribers.get(entity_id, ()):
+            button.update_entity(entity_id, state)
+
+    def apply_compressed(self, event: dict):
+        """Apply a subscribe_entities event: a = added, c = changed, r = removed."""
+        for entity_id, compressed in event.get("a", {}).items():
+            self.set(entity_id, _expand_state(entity_id, compressed))
+
+        for entity_id, diff in event.get("c", {}).items():
+            with self._lock:
+                current = self._states.get(entity_id)
+            if current is None:
+                continue
+            state = dict(current, attributes=dict(current.get("attributes", {})))
+            added = diff.get("+", {})
+            if "s" in added:
+                state["state"] = added["s"]
+            if "lc" in added:
+                state["last_changed"] = state["last_updated"] = added["lc"]
+            if "lu" in added:
+                state["last_updated"] = added["lu"]
+            state["attributes"].update(added.get("a", {}))
+            for attr in diff.get("-", {}).get("a", ()):
+                state["attributes"].pop(attr, None)
+            self.set(entity_id, state)
+
+        for entity_id in event.get("r", ()):
+            self.set(entity_id, {"entity_id": entity_id, "state": "unavailable", "attributes": {}})
+
+    def load_snapshot(self, path: Path):
+        """Seed the store from the last saved snapshot; decks paint it when they subscribe."""
+        try:
+            states = json.loads(path.read_text())
+        except (OSError, ValueError):
+            return
+        with self._lock:
+            for entity_id, state in states.items():
+                self._states.setdefault(entity_id, state)
+        print(f"Restored {len(states)} entity states from {path}", flush=True)
+
+    def save_snapshot(self, path: Path):
+        """Write watched entity states atomically, if anything changed."""
+        with self._lock:
+            if not self._changed:
+                return
+            states = {entity_id: state for entity_id, state in self._states.items()
+                      if not entity_id.startswith(LOCAL_PREFIX)}
+            self._changed = False
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_suffix(".tmp")
+            tmp.write_text(json.dumps(states))
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"Snapshot write failed: {e}", file=sys.stderr, flush=True)
+
+
+def _expand_state(entity_id: str, compressed: dict) -> dict:
+    """Turn a compressed subscribe_entities state into a get_states-style dict."""
+    last_changed = compressed.get("lc")
+    return {
+        "entity_id": entity_id,
+        "state": compressed.get("s", "unknown"),
+        "attributes": compressed.get("a", {}),
+        "last_changed": last_changed,
+        "last_updated": compressed.get("lu", last_changed),
+    }
+
+
+_entities = EntityStore()
+
+
+def publish_local(entity_id: str, state: str, attributes: dict):
+    """Feed a local pseudo-entity into the entity store if it changed."""
+    current = _entities.get(entity_id)
+    if current is not None and current["state"] == state and current["attributes"] == attributes:
+        return
+    stamp = time.strftime("%Y-%m-%dT%H:%M:%S%z")
+    _entities.set(entity_id, {"entity_id": entity_id, "state": state, "attributes": attributes,
+                              "last_changed": stamp, "last_updated": stamp})
+
+
+# === PipeWire Monitor ===
+
+class PipeWireMonitor:
+    """Default sink/source volume and mute, from one long-lived `pw-dump --monitor`.
+
+    PipeWire has no D-Bus interface; pw-dump streams every object change as
+    JSON arrays, which are decoded incrementally and published as the
+    local.audio_sink / local.audio_source entities (state "muted"/"unmuted",
+    attribute volume on wpctl's 0-1 scale).
+    """
+
+    def __init__(self):
+        self._objects: dict[int, dict] = {}
+        self._defaults: dict[str, str] = {}  # "sink"/"source" -> node.name
+
+    async def run(self):
+        while True:
+            try:
+                proc = await asyncio.create_subprocess_exec(
+                    "pw-dump", "--monitor", "--no-colors",
+                    stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+            except FileNotFoundError:
+                print("pw-dump not found, audio keys show no PipeWire state", flush=True)
+                return
+            self._objects.clear()
+            try:
+                await self._read(proc.stdout)
+            finally:
+                if proc.returncode is None:
+                    proc.kill()
+                await proc.wait()
+            print(f"pw-dump exited ({proc.returncode}), restarting", file=sys.stderr, flush=True)
+            await asyncio.sleep(5)
+
+    async def _read(self, stream):
+        decoder = json.JSONDecoder()
+        text = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        buffer = ""
+        while chunk := await stream.read(65536):
+            buffer += text.decode(chunk)
+            while buffer := buffer.lstrip():
+                try:
+                    batch, end = decoder.raw_decode(buffer)
+                except ValueError:
+                    break  # Incomplete; wait for the rest of the array
+                buffer = buffer[end:]
+                self._apply(batch)
+
+    def _apply(self, batch: list):
+        for obj in batch:
+            object_id = obj.get("id")
+            if "info" in obj and obj["info"] is None:
+                self._objects.pop(object_id, None)
+                continue
+            _merge(self._objects.setdefault(object_id, {}), obj)
+            for entry in obj.get("metadata") or ():
+                kind = {"default.audio.sink": "sink", "default.audio.source": "source"}.get(entry.get("key"))
+                if kind:
+                    value = entry.get("value")
+                    self._defaults[kind] = value.get("name") if isinstance(value, dict) else None
+        for kind in ("sink", "source"):
+            publish_local(f"local.audio_{kind}", *self._node_state(kind))
+
+    def _node_state(self, kind: str) -> tuple[str, dict]:
+        name = self._defaults.get(kind)
+        for obj in self._objects.values():
+            info = obj.get("info") or {}
+            if name and info.get("props", {}).get("node.name") == name:
+                break
+        else:
+            return "unavailable", {}
+        # The Props entry carrying channelVolumes is the node's own volume
+        props = next((p for p in info.get("params", {}).get("Props") or () if "channelVolumes" in p), {})
+        volumes = props.get("channelVolumes") or [1.0]
+        return ("muted" if props.get("mute") else "unmuted"), {
+            # Stored cubic; wpctl (and the keys) show the cube root
+            "volume": round(max(volumes) ** (1 / 3), 3),
+            "description": info.get("props", {}).get("node.description", name),
+        }
+
+
+def _merge(target: dict, update: dict):
+    """Recursively merge a pw-dump change into the object it updates."""
+    for key, value in update.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge(target[key], value)
+        else:
+            target[key] = value
+
+
+_pipewire = PipeWireMonitor()
+
+
+# === WS Frame Decoding ===
+# HA only sends subscribe_entities events for the watched entities, so every
+# frame is parsed; orjson, when installed, does that faster than json.
+
+_loads = orjson.loads if orjson else json.loads
+
+
+# === Native Encoding ===
+# The daemon encodes key images itself rather than through
+# PILHelper.to_native_format, which always saves JPEG at quality=100 with
+# Pillow's default chroma subsampling. Each deck gets a NativeEncoder with
+# its layout's settings; the encoder's tag (model, format, settings) is part
+# of every render cache key, so the disk cache holds ready-to-send bytes per
+# device model and settings, and changing the settings re-encodes.
+
+@dataclass(frozen=True)
+class EncodeSettings:
+    quality: int = JPEG_QUALITY
+    subsampling: str = JPEG_SUBSAMPLING
+
+
+@functools.lru_cache(maxsize=None)
+def _native_transpose(rotation: int, flip_x: bool, flip_y: bool) -> Image.Transpose | None:
+    """The one transpose equal to a key format's rotation and flips (None: no change)."""
+    _import_pil()
+    probe = Image.frombytes("L", (3, 2), bytes(range(6)))
+    target = _orient_steps(probe, rotation, flip_x, flip_y)
+    for method in Image.Transpose:
+        moved = probe.transpose(method)
+        if moved.size == target.size and moved.tobytes() == target.tobytes():
+            return method
+    return None
+
+
+def _orient_steps(image: Image.Image, rotation: int, flip_x: bool, flip_y: bool) -> Image.Image:
+    """Rotation and flips one step at a time, as PILHelper.to_native_format applies them."""
+    if rotation:
+        image = image.rotate(rotation, expand=True)
+    if flip_x:
+        image = image.transpose(Image.Transpose.FLIP_LEFT_RIGHT)
+    if flip_y:
+        image = image.transpose(Image.Transpose.FLIP_TOP_BOTTOM)
+    return image
+
+
+class NativeEncoder:
+    """Turns key images into one deck's native format (orientation + JPEG/BMP)."""
+
+    def __init__(self, deck, settings: EncodeSettings = EncodeSettings()):
+        self.format = deck.key_image_format()
+        self.settings = settings
+        self.jpeg = self.format["format"] == "JPEG"
+        # Identifies the bytes this encoder produces, for render cache keys
+        self.tag = (deck.deck_type(), self.format["format"],
+                    *((settings.quality, settings.subsampling) if self.jpeg else ()))
+
+    def orient(self, image: Image.Image) -> Image.Image:
+        """The device's rotation and flips, as one transpose where possible."""
+        rotation, (flip_x, flip_y) = self.format["rotation"] % 360, self.format["flip"]
+        method = _native_transpose(rotation, flip_x, flip_y)
+        if method is None:
+            return _orient_steps(image, rotation, flip_x, flip_y)
+        return image.transpose(method)
+
+    def encode(self, image: Image.Image) -> bytes:
+        """A key-sized image as native bytes."""
+        with _metrics.timer("streamdeck_native_encode_seconds"):
+            return self.save(self.orient(image))
+
+    def save(self, image: Image.Image) -> bytes:
+        """An image already in the device's orientation as native bytes."""
+        with io.BytesIO() as buffer:
+            if self.jpeg:
+                image.save(buffer, "JPEG", quality=self.settings.quality,
+                           subsampling=self.settings.subsampling)
+            else:
+                image.save(buffer, self.format["format"])
+            return buffer.getvalue()
+
+
+# === Page Backgrounds ===
+# A page background is fitted to the whole key grid once per frame when
+# loaded; each key that shows it starts from its own tile of that frame.
+# Animated ones redraw the see-through keys every frame.
+
+class Backdrop:
+    """A page background image spanning the key grid; a GIF/APNG animates."""
+
+    def __init__(self, path: str, deck):
+        from PIL import ImageOps, ImageSequence
+
+        _import_pil()
+        rows, columns = deck.key_layout()
+        self.key_size = width, height = deck.key_image_format()["size"]
+        size = (columns * width, rows * height)
+        # Top left corner of every key on the frame
+        self.origins = {key: (key % columns * width, key // columns * height)
+                        for key in range(deck.key_count())}
+        self.path = path
+        self.digest = _assets.digest(path)
+        self.frames: list[Image.Image] = []
+        self.delays: list[float] = []
+        self.index = 0
+        try:
+            with Image.open(path) as src:
+                for frame in ImageSequence.Iterator(src):
+                    self.frames.append(ImageOps.fit(frame.convert("RGB"), size, Image.Resampling.LANCZOS))
+                    self.delays.append(max(ANIMATION_MIN_FRAME_TIME, frame.info.get("duration", 100) / 1000))
+        except (OSError, ValueError) as e:
+            print(f"Page background {path}: {e}", file=sys.stderr, flush=True)
+            self.frames, self.delays = [Image.new("RGB", size)], [ANIMATION_MIN_FRAME_TIME]
+
+    @property
+    def animated(self) -> bool:
+        return len(self.frames) > 1
+
+    def frame(self) -> Image.Image:
+        return self.frames[self.index]
+
+    def advance(self) -> float:
+        """Step to the next frame; return how long to show it."""
+        self.index = (self.index + 1) % len(self.frames)
+        return self.delays[self.index]
+
+    def tile(self, key: int) -> Image.Image:
+        """The current frame's part under one key, as a new key-sized image."""
+        x, y = self.origins[key]
+        width, height = self.key_size
+        return self.frame().crop((x, y, x + width, y + height))
+
+    def tile_key(self, key: int) -> tuple:
+        """What a key's pixels depend on, for render cache keys."""
+        return (self.digest, key, self.index)
+
+
+# === Deck Writer ===
+# Runs on the event loop like everything else. Key events, HA updates and
+# the screensaver only mark keys dirty or request a brightness/blank change;
+# one flush task per deck renders the latest state of each dirty key and
+# hands the writes to the USB executor. Repeated redraws of the same key
+# coalesce into a single write.
+#
+# Every page keeps a framebuffer of native key images. Updates to keys on
+# hidden pages (or while blanked) are rendered into their framebuffer only,
+# so switching pages or waking is just key_count writes with no PIL work.
+
+# The one thread that talks to the decks (set_key_image, brightness, open/reset)
+_usb = ThreadPoolExecutor(max_workers=1, thread_name_prefix="usb")
+
+
+class DeckWriter:
+    """Owns the deck: per-page framebuffers, dirty-key rendering, brightness."""
+
+    def __init__(self, deck):
+        self.deck = deck
+        self.pages: dict[str, dict[int, "Button"]] = {}
+        self.page: str | None = None
+        self.page_stack: list[str] = []
+        self.brightness = None       # Last level handed to the USB executor
+        self._framebuffers: dict[str, dict[int, bytes]] = {}
+        self._dirty: set[tuple[str, int]] = set()
+        self._show = False           # push the current page's framebuffer to the deck
+        self._target_brightness = None
+        self._blanked = False        # keys not drawn; framebuffers still update
+        self._blank_pending = False
+        self._stopped = False
+        self._prerender: deque["Button"] = deque()
+        self._black_native = None
+        # Native image each key shows, so identical rewrites are skipped
+        self._on_deck: dict[int, bytes] = {}
+        self._task: asyncio.Task | None = None
+        self.painted = asyncio.Event()  # Set once the first batch of writes is done
+        self.encoder = NativeEncoder(deck)
+        self._backdrops: dict[str, Backdrop] = {}  # by page
+        self._frame_timer: asyncio.TimerHandle | None = None  # visible page's next animation frame
+
+    @property
+    def buttons(self) -> dict[int, "Button"]:
+        """Buttons of the page currently shown."""
+        return self.pages.get(self.page, {})
+
+    def start(self):
+        # Through the render cache too, so a warm start needs no PIL for it
+        key = (self.encoder.tag, "black")
+        self._black_native = _render_cache.get_or_render(
+            key, self._encode_black, hashlib.sha256(_CODE_DIGEST + repr(key).encode()).hexdigest())
+
+    def _encode_black(self) -> bytes:
+        _import_pil()
+        return self.encoder.encode(PILHelper.create_image(self.deck, background="#000000"))
+
+    def set_encoding(self, settings: EncodeSettings):
+        """Encode with new settings from now on (the caller redraws)."""
+        if settings == self.encoder.settings:
+            return
+        self.encoder = NativeEncoder(self.deck, settings)
+        self.start()
+
+    async def stop(self):
+        """Stop drawing, after the writes already handed to the executor."""
+        self._stopped = True
+        self._animate()
+        if self._task is not None:
+            await asyncio.wait([self._task])
+
+    def mark_dirty(self, page: str, key: int):
+        self._dirty.add((page, key))
+        self._kick()
+
+    def set_pages(self, pages: dict[str, dict[int, "Button"]], start_page: str,
+                  backgrounds: Mapping[str, str] | None = None):
+        """Swap in a new layout: render every page, show start_page, prerender states when idle."""
+        self.pages = pages
+        self.page = start_page
+        self.page_stack = []
+        self._backdrops = {page: Backdrop(path, self.deck)
+                           for page, path in (backgrounds or {}).items() if page in pages}
+        self._framebuffers = {name: {} for name in pages}
+        self._dirty = {(page, key) for page in pages for key in range(self.deck.key_count())}
+        self._show = True
+        self._prerender.clear()
+        for page, buttons in pages.items():
+            backdrop = self._backdrops.get(page)
+            for button in buttons.values():
+                button.backdrop = backdrop
+            self._prerender.extend(button for button in buttons.values() if button.cacheable())
+        self._kick()
+        self._animate()
+
+    def show_page(self, name: str):
+        """Open a page, remembering the current one for back()."""
+        if name not in self.pages or name == self.page:
+            return
+        self.page_stack.append(self.page)
+        self.page = name
+        self._show = True
+        self._kick()
+        self._animate()
+
+    def back(self):
+        """Return to the previously shown page."""
+        if not self.page_stack:
+            return
+        self.page = self.page_stack.pop()
+        self._show = True
+        self._kick()
+        self._animate()
+
+    def set_brightness(self, level: int):
+        self._target_brightness = level
+        self._kick()
+
+    def blank(self):
+        """Black out every key; updates keep landing in the framebuffers meanwhile."""
+        self._blanked = True
+        self._blank_pending = True
+        self._kick()
+        self._animate()
+
+    def hold(self):
+        """Stop drawing but leave the keys' images on the deck."""
+        self._blanked = True
+        self._animate()
+
+    def unblank(self):
+        """Resume drawing; only keys whose image changed meanwhile are rewritten."""
+        self._blanked = False
+        self._blank_pending = False
+        self._show = True
+        self._kick()
+        self._animate()
+
+    def _animate(self):
+        """Run the shown page's backdrop animation, and only while the keys are drawn."""
+        if self._frame_timer is not None:
+            self._frame_timer.cancel()
+            self._frame_timer = None
+        backdrop = self._backdrops.get(self.page)
+        if backdrop is None or not backdrop.animated or self._blanked or self._stopped:
+            return
+        self._frame_timer = asyncio.get_running_loop().call_later(
+            backdrop.delays[backdrop.index], self._next_frame, backdrop)
+
+    def _next_frame(self, backdrop: Backdrop):
+        self._frame_timer = None
+        backdrop.advance()
+        # Keys with a bg_color of their own don't change with the frame
+        buttons = self.pages[self.page]
+        self._dirty.update((self.page, key) for key in range(self.deck.key_count())
+                           if key not in buttons or buttons[key].shows_backdrop())
+        self._kick()
+        self._animate()
+
+    def _kick(self):
+        if not self._stopped and (self._task is None or self._task.done()):
+            self._task = asyncio.get_running_loop().create_task(self._flush())
+
+    async def _flush(self):
+        """Render what changed and write it; runs until there is no work left.
+
+        Updates arriving while a batch is being written pile up in the dirty
+        set, so a key redrawn many times meanwhile is rendered and written once.
+        """
+        loop = asyncio.get_running_loop()
+        while not self._stopped:
+            brightness, self._target_brightness = self._target_brightness, None
+            blank, self._blank_pending = self._blank_pending, False
+            dirty, self._dirty = self._dirty, set()
+            show = self._show and not self._blanked
+            self._show = False  # unblank() asks again when blanked
+
+            if not (dirty or show or blank or brightness is not None):
+                if not self._prerender:
+                    return
+                # Warm the render cache one button at a time, only when otherwise idle
+                button = self._prerender.popleft()
+                try:
+                    button.prerender()
+                except Exception as e:
+                    print(f"Prerender error key {button.key}: {e}", file=sys.stderr, flush=True)
+                await asyncio.sleep(0)
+                continue
+
+            writes = self._plan(brightness, blank, dirty, show)
+            if writes:
+                for key in await loop.run_in_executor(_usb, self._write, writes):
+                    self._on_deck.pop(key, None)  # Unknown after a failed write; retry next time
+                self.painted.set()
+
+    def _plan(self, brightness, blank: bool, dirty: set, show: bool) -> list[tuple[int | None, Any]]:
+        """Render into the framebuffers; return the (key, image) / (None, brightness) writes."""
+        writes = []
+        visible = None if self._blanked else self.page
+
+        # Lower brightness before drawing, raise it after, so transitions never flash
+        dimming = brightness is not None and brightness < (self.brightness or 0)
+        if brightness is not None and (dimming or blank):
+            writes.append((None, brightness))
+            self.brightness, brightness = brightness, None
+        if blank:
+            for key in range(self.deck.key_count()):
+                self._queue_key(writes, key, self._black_native)
+
+        # Visible page first; hidden pages only update their framebuffer
+        by_page: dict[str, list[int]] = {}
+        for page, key in sorted(dirty, key=lambda pk: (pk[0] != visible, pk)):
+            if page in self.pages:
+                by_page.setdefault(page, []).append(key)
+        for page, keys in by_page.items():
+            for key, native in self._render_keys(page, keys).items():
+                self._framebuffers[page][key] = native
+                if page == visible and not show:
+                    self._queue_key(writes, key, native)
+
+        if show:
+            framebuffer = self._framebuffers[visible]
+            missing = [key for key in range(self.deck.key_count()) if key not in framebuffer]
+            if missing:
+                framebuffer.update(self._render_keys(visible, missing))
+            for key in range(self.deck.key_count()):
+                if key in framebuffer:
+                    self._queue_key(writes, key, framebuffer[key])
+
+        if brightness is not None:
+            writes.append((None, brightness))
+            self.brightness = brightness
+        return writes
+
+    def _queue_key(self, writes: list, key: int, native: bytes):
+        last = self._on_deck.get(key)
+        # Cache hits hand back the same bytes object, so `is` settles most cases
+        if last is native or last == native:
+            _metrics.inc("streamdeck_key_writes_skipped_total")
+            return
+        self._on_deck[key] = native
+        writes.append((key, native))
+
+    def _render_keys(self, page: str, keys: list[int]) -> dict[int, bytes]:
+        """Native images for keys of a page: render cache hits, else rendered and stored."""
+        buttons = self.pages[page]
+        rendered = {}
+        for key in keys:
+            button = buttons.get(key)
+            if button is None:
+                rendered[key] = self._black_native
+                continue
+            native = button.cached_native()
+            if native is None:
+                try:
+                    native = button._encode()
+                except Exception as e:
+                    print(f"Render error key {key}: {e}", file=sys.stderr, flush=True)
+                    continue
+                if native is None:
+                    continue
+                button.store_native(native)
+            rendered[key] = native
+        return rendered
+
+    def _write(self, writes: list) -> list[int]:
+        """USB executor: perform the writes in order; return the keys that failed."""
+        failed = []
+        for key, data in writes:
+            if key is None:
+                try:
+                    self.deck.set_brightness(data)
+                except Exception as e:
+                    print(f"Brightness {data}% failed: {e}", file=sys.stderr, flush=True)
+                continue
+            try:
+                with _metrics.timer("streamdeck_set_key_image_seconds"):
+                    self.deck.set_key_image(key, data)
+            except Exception as e:
+                failed.append(key)
+                print(f"Display error key {key}: {e}", file=sys.stderr, flush=True)
+        return failed
 
 
 # === Button Definitions ===
 
 class Button:
     """Base button class."""
-    # Class-level flag to suppress display updates during screensaver
-    _display_suspended = False
-
-    def __init__(self, key: int, text: str = "", icon: str = "", bg_color: str = "#000000"):
+    # Distinguishes render() implementations in the render cache key
+    render_variant = "default"
+    # HA entities this button displays; the entity store calls update_entity() for them
+    watched_entities: frozenset[str] = frozenset()
+    # Without a bg_color of its own, render() draws over the page background
+    see_through = True
+    # Layout options restricted to a fixed set of values
+    option_choices: dict[str, tuple] = {}
+    # Gestures (see GestureRecognizer): step again while held, and alternate
+    # service calls, which hold the tap back until the gesture is decided
+    repeat = False
+    long_press: dict | None = None
+    double_tap: dict | None = None
+
+    def __init__(self, key: int, text: str = "", icon: str = "", bg_color: str | None = "#000000"):
         self.key = key
         self.text = text
         self.icon = icon
-        self.bg_color = bg_color
+        self.bg_color = bg_color  # None: the page backdrop shows through
         self.deck = None
+        self.writer: DeckWriter | None = None
+        self.page: str | None = None  # Page this button lives on
+        self.backdrop: Backdrop | None = None  # Page background under this key
+        self.failed = False  # Last HA call from this button failed
+        self._pressed = False
 
     def render(self) -> Image.Image:
         """Render button image."""
         if self.deck is None:
             return None
 
-        # Create image with background color
-        image = PILHelper.create_image(self.deck, background=self.bg_color)
+        # Background color, or the page backdrop (lightened while pressed)
+        if not self.shows_backdrop():
+            image = PILHelper.create_image(self.deck, background=self.bg_color or "black")
+        elif self._pressed:
+            tile = self.backdrop.tile(self.key)
+            image = Image.blend(tile, Image.new("RGB", tile.size, "white"), 0.6)
+        else:
+            image = self.backdrop.tile(self.key)
         draw = ImageDraw.Draw(image)
 
-        # Load icon if specified
-        if self.icon and Path(self.icon).exists():
-            icon_img = Image.open(self.icon).convert("RGBA")
-            # Resize icon to fit (leave room for text)
-            icon_size = (48, 48) if self.text else (64, 64)
-            icon_img = icon_img.resize(icon_size, Image.Resampling.LANCZOS)
+        # Icon if specified, sized to leave room for text
+        icon_img = _assets.icon(self.icon, 48 if self.text else 64)
+        if icon_img is not None:
             # Center horizontally, offset vertically if text
             x = (image.width - icon_img.width) // 2
             y = 5 if self.text else (image.height - icon_img.height) // 2
             image.paste(icon_img, (x, y), icon_img)
 
-        # Draw text
+        # Draw text, from cached masks (same pixels as draw.text)
         if self.text:
-            try:
-                font = ImageFont.truetype(FONT_PATH, FONT_SIZE_SMALL if "\n" in self.text else FONT_SIZE)
-            except OSError:
-                font = ImageFont.load_default()
+            size = FONT_SIZE_SMALL if "\n" in self.text else FONT_SIZE
 
             # Handle multi-line text
             lines = self.text.split("\n")
             y_offset = 55 if self.icon else (image.height // 2 - len(lines) * 8)
 
             for line in lines:
-                bbox = draw.textbbox((0, 0), line, font=font)
-                text_width = bbox[2] - bbox[0]
-                x = (image.width - text_width) // 2
-                draw.text((x, y_offset), line, font=font, fill="white")
+                if line:
+                    mask, (left, top, right, _) = _assets.text(line, size)
+                    x = (image.width - (right - left)) // 2 + left
+                    draw.bitmap((x, y_offset + top), mask, fill="white")
                 y_offset += 16
 
         return image
 
-    def update_display(self):
-        """Update the physical button display."""
-        if self.deck is None or Button._display_suspended:
-            return
-        try:
+    def cache_key(self) -> tuple:
+        """Everything that affects the rendered pixels of this button."""
+        backdrop = None
+        if self.shows_backdrop():
+            backdrop = self.backdrop.tile_key(self.key) + (self._pressed,)
+        return (self.encoder().tag, self.bg_color, self.icon, self.text, self.render_variant,
+                self.failed, backdrop)
+
+    def content_hash(self, key: tuple) -> str:
+        """Hash of everything behind the pixels, including icon and font files."""
+        h = hashlib.sha256(_CODE_DIGEST)
+        h.update(repr(key).encode())
+        h.update(_assets.digest(self.icon).encode())
+        h.update(str(FONT_PATH).encode())
+        return h.hexdigest()
+
+    def encoder(self) -> NativeEncoder:
+        """The deck writer's encoder (default settings for a button without one)."""
+        if self.writer is not None:
+            return self.writer.encoder
+        return NativeEncoder(self.deck)
+
+    def shows_backdrop(self) -> bool:
+        """Whether the page background shows through (no bg_color of its own)."""
+        return self.backdrop is not None and self.bg_color is None
+
+    def cacheable(self) -> bool:
+        """Whether the current look is worth keeping in the render cache."""
+        # Over an animated background every frame is a new look
+        return not (self.shows_backdrop() and self.backdrop.animated)
+
+    def render_native(self) -> bytes | None:
+        """Render to the deck's native format, served from the render cache when possible."""
+        if not self.cacheable():
+            return self._encode()
+        key = self.cache_key()
+        return _render_cache.get_or_render(key, self._encode, self.content_hash(key))
+
+    def cached_native(self) -> bytes | None:
+        """The render cache's image for the current look; None on a miss (nothing is rendered)."""
+        if not self.cacheable():
+            return None
+        key = self.cache_key()
+        return _render_cache.get(key, self.content_hash(key))
+
+    def store_native(self, data: bytes):
+        """Keep an image rendered after a cached_native() miss for the current look."""
+        if self.cacheable():
+            key = self.cache_key()
+            _render_cache.put(key, data, self.content_hash(key))
+
+    def _encode(self) -> bytes | None:
+        """Render and convert to the deck's native format, bypassing the cache."""
+        _import_pil()
+        with _metrics.timer("streamdeck_render_seconds"):
             image = self.render()
-            if image:
-                self.deck.set_key_image(self.key, PILHelper.to_native_format(self.deck, image))
-        except Exception as e:
-            print(f"Display error key {self.key}: {e}", file=sys.stderr, flush=True)
+            if image is None:
+                return None
+            if self.failed:
+                # Red bar along the bottom edge marks a failed HA call
+                ImageDraw.Draw(image).rectangle(
+                    (0, image.height - 6, image.width - 1, image.height - 1), fill="#ff1744")
+        return self.encoder().encode(image)
+
+    def prerender(self):
+        """Warm the render cache with this button's idle and pressed looks."""
+        self.render_native()
+        pressed = copy.copy(self)
+        pressed.bg_color = self._brighten_color(self.bg_color)
+        pressed._pressed = True
+        pressed.render_native()
+
+    def update_display(self):
+        """Schedule a redraw; the deck writer renders the latest state."""
+        if self.writer is not None:
+            self.writer.mark_dirty(self.page, self.key)
+
+    def update_entity(self, entity_id: str, state_data: dict):
+        """Called when a watched entity changes state."""
+
+    def on_result(self, success: bool, error=None):
+        """Called with the outcome of a service call made by this button."""
+        if self.failed != (not success):
+            self.failed = not success
+            self.update_display()
 
     def on_press(self):
         """Called when button is pressed."""
-        # Flash effect - brighten background
-        self._original_bg = self.bg_color
-        self.bg_color = self._brighten_color(self.bg_color)
-        self.update_display()
+        self.press_feedback(True)
 
     def on_release(self):
         """Called when button is released."""
-        # Restore original background
-        if hasattr(self, '_original_bg'):
+        self.press_feedback(False)
+
+    def press_feedback(self, pressed: bool):
+        """Show or clear the pressed look without acting on the press."""
+        self._pressed = pressed
+        if pressed:
+            # Flash effect - brighten background
+            self._original_bg = self.bg_color
+            self.bg_color = self._brighten_color(self.bg_color)
+            self.update_display()
+        elif hasattr(self, '_original_bg'):
+            # Restore original background
             self.bg_color = self._original_bg
             self.update_display()
 
-    def _brighten_color(self, hex_color: str) -> str:
+    def on_repeat(self, count: int):
+        """Called count times so far while a repeat key is held."""
+
+    def on_long_press(self):
+        """Called when a key with a long_press alternate is held long enough."""
+
+    def on_double_tap(self):
+        """Called on the second tap of a key with a double_tap alternate."""
+
+    def _brighten_color(self, hex_color: str | None) -> str | None:
         """Brighten a hex color for press feedback."""
+        if hex_color is None:
+            return None  # Transparent keys lighten the backdrop instead (see render)
         hex_color = hex_color.lstrip('#')
         r, g, b = int(hex_color[0:2], 16), int(hex_color[2:4], 16), int(hex_color[4:6], 16)
         # Brighten by 60% for more visible feedback
@@ -163,50 +2009,269 @@ class Button:
         return f"#{r:02x}{g:02x}{b:02x}"
 
 
+class PageButton(Button):
+    """Folder key: opens another page of the layout."""
+    def __init__(self, key: int, target: str, **kwargs):
+        super().__init__(key, **kwargs)
+        self.target = target
+
+    def on_press(self):
+        super().on_press()
+        self.writer.show_page(self.target)
+
+
+class BackButton(Button):
+    """Returns to the page that opened the current one."""
+    def __init__(self, key: int, text: str = "Back", **kwargs):
+        super().__init__(key, text=text, **kwargs)
+
+    def on_press(self):
+        super().on_press()
+        self.writer.back()
+
+
 class CommandButton(Button):
-    """Button that runs a shell command."""
-    def __init__(self, key: int, command: str, **kwargs):
+    """Button that runs a command; policy decides what a press during a run does."""
+    option_choices = {"policy": ("single", "queue", "restart")}
+
+    def __init__(self, key: int, command: str, policy: str = "queue",
+                 timeout: float = COMMAND_TIMEOUT, feedback: bool = True, repeat: bool = False,
+                 **kwargs):
         super().__init__(key, **kwargs)
         self.command = command
+        self.policy = policy
+        self.timeout = timeout
+        self.feedback = feedback  # Red bar on the key while the last run failed
+        self.repeat = repeat  # Run again while held
 
     def on_press(self):
         super().on_press()
+        self.run_command()
+
+    def on_repeat(self, count: int):
+        self.run_command()
+
+    def run_command(self):
         if self.command:
-            subprocess.Popen(self.command, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            _runner.submit(self, self.command, self.policy, self.timeout,
+                           self.on_result if self.feedback else None)
 
     def on_release(self):
         super().on_release()
 
 
 class HAButton(Button):
-    """Button that calls Home Assistant service via WS."""
-    def __init__(self, key: int, service: str, entity_id: str, **kwargs):
+    """Button that calls Home Assistant service via WS.
+
+    long_press / double_tap are alternate calls: {service, entity_id (default
+    the key's own), data (extra service data)}.
+    """
+    def __init__(self, key: int, service: str, entity_id: str, long_press: dict | None = None,
+                 double_tap: dict | None = None, **kwargs):
         super().__init__(key, **kwargs)
         # service is "domain/service" e.g. "light/toggle"
         domain, _, svc = service.partition("/")
         self.domain = domain
         self.svc = svc
         self.entity_id = entity_id
+        self.long_press = long_press
+        self.double_tap = double_tap
 
     def on_press(self):
         super().on_press()
-        call_ha_service(self.domain, self.svc, entity_id=self.entity_id)
+        call_ha_service(self.domain, self.svc, on_result=self.on_result, entity_id=self.entity_id)
 
     def on_release(self):
         super().on_release()
 
+    def on_long_press(self):
+        self._call_alternate(self.long_press)
+
+    def on_double_tap(self):
+        self._call_alternate(self.double_tap)
+
+    def _call_alternate(self, alternate: dict):
+        domain, _, svc = alternate["service"].partition("/")
+        service_data = {"entity_id": alternate.get("entity_id", self.entity_id), **alternate.get("data", {})}
+        call_ha_service(domain, svc, on_result=self.on_result, **service_data)
+
+
+class StateStyleMixin:
+    """Per-state overrides of bg_color / icon / text, from a layout's states tables."""
+
+    def _init_states(self, states: dict[str, dict] | None):
+        # state -> overrides; unlisted states use the base look
+        self.states = states or {}
+        self.base_style = {"bg_color": self.bg_color, "icon": self.icon, "text": self.text}
+
+    def _apply_style(self, state: str | None, pressed: bool):
+        style = dict(self.base_style)
+        style.update(self.states.get(state, {}))
+        self.icon = style["icon"]
+        self.text = style["text"]
+        self.bg_color = self._brighten_color(style["bg_color"]) if pressed else style["bg_color"]
+
+    def prerender(self):
+        """Warm the render cache for every declared state, idle and pressed."""
+        for state in (None, *self.states):
+            for pressed in (False, True):
+                variant = copy.copy(self)
+                variant._apply_style(state, pressed)
+                variant._pressed = pressed
+                variant.render_native()
+
+
+class StatefulHAButton(StateStyleMixin, HAButton):
+    """HA button that shows its entity's state and predicts the result of a press.
+
+    On press the predicted state is drawn immediately; the subscribe_entities
+    update confirms it, while an error result or OPTIMISTIC_TIMEOUT without
+    confirmation rolls back to the last state HA reported.
+    """
+    # service -> predicted new state (a dict maps from the current state)
+    PREDICTIONS = {
+        "toggle": {"on": "off", "off": "on", "open": "closed", "closed": "open",
+                   "opening": "closed", "closing": "open"},
+        "turn_on": "on",
+        "turn_off": "off",
+        "open_cover": "open",
+        "close_cover": "closed",
+        "lock": "locked",
+        "unlock": "unlocked",
+    }
+
+    def __init__(self, key: int, service: str, entity_id: str, states: dict[str, dict] | None = None,
+                 **kwargs):
+        super().__init__(key, service, entity_id, **kwargs)
+        self._init_states(states)
+        self.watched_entities = frozenset({entity_id})
+        self.predicted = None
+        self._prediction_seq = 0
+
+    def actual_state(self) -> str | None:
+        state = _entities.get(self.entity_id)
+        return state.get("state") if state else None
+
+    def _predict(self, current: str | None) -> str | None:
+        prediction = self.PREDICTIONS.get(self.svc)
+        if isinstance(prediction, dict):
+            return prediction.get(current)
+        return prediction
+
+    def _refresh_display(self):
+        self._apply_style(self.predicted or self.actual_state(), self._pressed)
+        self.update_display()
+
+    def update_entity(self, entity_id: str, state_data: dict):
+        # Any HA-reported state supersedes the prediction once it matches; a
+        # different state may be an intermediate one, so wait for the timeout
+        if self.predicted is not None and state_data.get("state") == self.predicted:
+            self.predicted = None
+        self._refresh_display()
+
+    def on_result(self, success: bool, error=None):
+        if not success:
+            self.predicted = None
+            self._refresh_display()
+        super().on_result(success, error)
+
+    def _expire_prediction(self, seq: int):
+        if seq == self._prediction_seq and self.predicted is not None:
+            self.predicted = None
+            self._refresh_display()
+
+    def on_press(self):
+        self._pressed = True
+        predicted = self._predict(self.predicted or self.actual_state())
+        if predicted is not None:
+            self.predicted = predicted
+            self._prediction_seq += 1
+            call_later(OPTIMISTIC_TIMEOUT, self._expire_prediction, self._prediction_seq)
+        self._refresh_display()
+        call_ha_service(self.domain, self.svc, on_result=self.on_result, entity_id=self.entity_id)
+
+    def on_release(self):
+        self.press_feedback(False)
+
+    def press_feedback(self, pressed: bool):
+        self._pressed = pressed
+        self._refresh_display()
+
+
+class LocalStateButton(StateStyleMixin, CommandButton):
+    """Command key showing a local pseudo-entity: PipeWire mute/volume or MPRIS playback.
+
+    entity_id is local.audio_sink, local.audio_source or local.media; states
+    restyle the key per state and level = true draws the volume as a bar.
+    """
+    render_variant = "local"
+    option_choices = {**CommandButton.option_choices,
+                      "entity_id": ("local.audio_sink", "local.audio_source", "local.media")}
+
+    def __init__(self, key: int, command: str, entity_id: str, states: dict[str, dict] | None = None,
+                 level: bool = False, **kwargs):
+        super().__init__(key, command, **kwargs)
+        self._init_states(states)
+        self.entity_id = entity_id
+        self.show_level = level
+        self.watched_entities = frozenset({entity_id})
+        self.state = None
+        self.level = None  # Volume 0-1 rounded to the bar's resolution
+
+    def update_entity(self, entity_id: str, state_data: dict):
+        self.state = state_data.get("state")
+        volume = state_data.get("attributes", {}).get("volume")
+        self.level = round(min(volume, 1.0), 2) if self.show_level and volume is not None else None
+        self._refresh_display()
+
+    def _refresh_display(self):
+        self._apply_style(self.state, self._pressed)
+        self.update_display()
+
+    def cache_key(self) -> tuple:
+        return super().cache_key() + (self.level,)
+
+    def render(self) -> Image.Image:
+        image = super().render()
+        if image is not None and self.level is not None:
+            # Volume bar along the bottom edge
+            draw = ImageDraw.Draw(image)
+            top = image.height - 4
+            draw.rectangle((4, top, image.width - 5, image.height - 2), fill="#212121")
+            draw.rectangle((4, top, 4 + round((image.width - 9) * self.level), image.height - 2),
+                           fill="white")
+        return image
+
+    def on_press(self):
+        self._pressed = True
+        self._refresh_display()
+        self.run_command()
+
+    def on_release(self):
+        self._pressed = False
+        self._refresh_display()
+
 
 class VolumeButton(Button):
-    """Volume button via WS."""
+    """Volume button via WS; rapid presses and held repeats coalesce into one volume_set
+    per VOLUME_COALESCE_WINDOW."""
+    option_choices = {"direction": ("up", "down")}
+    repeat = True
+
     def __init__(self, key: int, entity_id: str, direction: str = "up", **kwargs):
         super().__init__(key, **kwargs)
         self.entity_id = entity_id
         self.direction = direction
+        # Watched so the entity store knows the current volume_level
+        self.watched_entities = frozenset({entity_id})
 
     def on_press(self):
         super().on_press()
-        svc = "volume_up" if self.direction == "up" else "volume_down"
-        call_ha_service("media_player", svc, entity_id=self.entity_id)
+        self.on_repeat(0)
+
+    def on_repeat(self, count: int):
+        delta = VOLUME_STEP if self.direction == "up" else -VOLUME_STEP
+        _commands.step_volume(self.entity_id, delta, on_result=self.on_result)
 
     def on_release(self):
         super().on_release()
@@ -214,6 +2279,9 @@ class VolumeButton(Button):
 
 class TRVButton(Button):
     """Climate TRV button with real-time state updates via input_boolean + temp sensor."""
+    render_variant = "trv"
+    see_through = False
+
     def __init__(self, key: int, toggle_entity: str, temp_entity: str, label: str = "Office", **kwargs):
         super().__init__(key, **kwargs)
         self.toggle_entity = toggle_entity
@@ -225,7 +2293,7 @@ class TRVButton(Button):
         self.bg_color = "#37474f"  # Blue-grey (off state) instead of black
         self.text = f"{label}\n--°C"
         # Entities this button watches
-        self.watched_entities = {toggle_entity, temp_entity}
+        self.watched_entities = frozenset({toggle_entity, temp_entity})
 
     def update_entity(self, entity_id: str, state_data: dict):
         """Update button from a single entity's state change."""
@@ -261,17 +2329,13 @@ class TRVButton(Button):
         draw = ImageDraw.Draw(image)
 
         # Smaller icon at top
-        if self.icon and Path(self.icon).exists():
-            icon_img = Image.open(self.icon).convert("RGBA")
-            icon_img = icon_img.resize((32, 32), Image.Resampling.LANCZOS)
+        icon_img = _assets.icon(self.icon, 32)
+        if icon_img is not None:
             x = (image.width - 32) // 2
             image.paste(icon_img, (x, 2), icon_img)
 
         # Two lines of text below icon
-        try:
-            font = ImageFont.truetype(FONT_PATH, FONT_SIZE_SMALL)
-        except OSError:
-            font = ImageFont.load_default()
+        font = _assets.font(FONT_SIZE_SMALL)
 
         lines = self.text.split("\n")
         y = 36
@@ -287,68 +2351,519 @@ class TRVButton(Button):
     def on_press(self):
         """Toggle heating via input_boolean over WS."""
         super().on_press()
-        call_ha_service("input_boolean", "toggle", entity_id=self.toggle_entity)
+        call_ha_service("input_boolean", "toggle", on_result=self.on_result,
+                        entity_id=self.toggle_entity)
 
     def on_release(self):
         # Re-render with current HA state instead of restoring old bg
+        self._pressed = False
         self._refresh_display()
 
 
-# === Button Layout ===
+class SensorTileButton(Button):
+    """Live sensor tile: the current value over a sparkline of recent history, or a gauge.
 
-def create_buttons() -> dict[int, Button]:
-    """Create all buttons."""
-    return {
-        0: CommandButton(0, "playerctl play-pause",
-                        text="Play/Pause", icon=str(ICONS_DIR / "playpause.png"), bg_color="#1e88e5"),
-        1: CommandButton(1, "wpctl set-volume @DEFAULT_AUDIO_SINK@ 5%-",
-                        text="Vol -", icon=str(ICONS_DIR / "volume.png"), bg_color="#1e88e5"),
-        2: CommandButton(2, "wpctl set-volume @DEFAULT_AUDIO_SINK@ 5%+",
-                        text="Vol +", icon=str(ICONS_DIR / "volume.png"), bg_color="#1e88e5"),
-        3: CommandButton(3, "wpctl set-mute @DEFAULT_AUDIO_SINK@ toggle",
-                        text="Mute", icon=str(ICONS_DIR / "mute.png"), bg_color="#e53935"),
-        4: HAButton(4, "light/toggle", "light.office",
-                   text="Office", icon=str(ICONS_DIR / "light.png"), bg_color="#fbc02d"),
-        5: TRVButton(5, toggle_entity="input_boolean.climate_office_toggle",
-                    temp_entity="sensor.awair_element_54484_temperature", label="Office"),
-        6: HAButton(6, "script/turn_on", "script.good_night",
-                   text="Good Night", icon=str(ICONS_DIR / "sleep.png"), bg_color="#3949ab"),
-        7: HAButton(7, "light/turn_off", "all",
-                   text="Lights Off", icon=str(ICONS_DIR / "off.png"), bg_color="#c62828"),
-        8: VolumeButton(8, "media_player.bureau", direction="down",
-                       text="Sonos -", icon=str(ICONS_DIR / "vol_down.png"), bg_color="#1db954"),
-        9: VolumeButton(9, "media_player.bureau", direction="up",
-                       text="Sonos +", icon=str(ICONS_DIR / "vol_up.png"), bg_color="#1db954"),
-        10: CommandButton(10, 'FILE=/home/mike/Downloads/screenshot-$(date +%Y%m%d-%H%M%S).png; grim -g "$(slurp)" - | tee "$FILE" | wl-copy -t image/png',
-                         text="Screenshot", icon=str(ICONS_DIR / "screenshot.png"), bg_color="#5e35b1"),
-        11: CommandButton(11, "loginctl lock-session",
-                         text="Lock", icon=str(ICONS_DIR / "lock.png"), bg_color="#00695c"),
-        12: CommandButton(12, "wpctl set-mute @DEFAULT_AUDIO_SOURCE@ toggle",
-                         text="Mic Mute", icon=str(ICONS_DIR / "microphone.png"), bg_color="#e53935"),
-        13: HAButton(13, "cover/toggle", "cover.curtain_3_3fb4",
-                    text="Blinds", icon=str(ICONS_DIR / "blinds.png"), bg_color="#f57f17"),
-        14: Button(14),  # Empty
-    }
+    The sparkline is kept as an image between renders; new samples scroll it
+    left and only their columns are drawn. Redraws are rate-limited to one per
+    min_interval seconds, so a chatty sensor can't saturate the deck writer.
+    """
+    render_variant = "sensor"
+    see_through = False
+    option_choices = {"style": ("sparkline", "gauge")}
+
+    def __init__(self, key: int, entity_id: str, label: str = "", style: str = "sparkline",
+                 unit: str | None = None, min_value: float | None = None, max_value: float | None = None,
+                 line_color: str = "#4fc3f7", min_interval: float = SENSOR_TILE_MIN_INTERVAL, **kwargs):
+        kwargs.setdefault("bg_color", "#263238")
+        super().__init__(key, **kwargs)
+        self.entity_id = entity_id
+        self.label = label
+        self.style = style
+        self.unit = unit or ""
+        self.range = (min_value, max_value)  # None = fit to the visible history
+        self.line_color = line_color
+        self.min_interval = min_interval
+        self.watched_entities = frozenset({entity_id})
+        self.history = _entities.history(entity_id)
+        self.value: float | None = None
+        self._unit_from_state = unit is None
+        self._last_draw = 0.0
+        self._redraw_pending = False
+        # Sparkline plot between renders (event loop only)
+        self._plot: Image.Image | None = None
+        self._plot_total = 0       # history.total drawn into the plot
+        self._plot_scale = None    # (low, high) the plot is drawn at
+
+    def update_entity(self, entity_id: str, state_data: dict):
+        try:
+            self.value = float(state_data.get("state"))
+        except (TypeError, ValueError):
+            self.value = None
+        if self._unit_from_state:
+            self.unit = state_data.get("attributes", {}).get("unit_of_measurement", "")
+
+        wait = self._last_draw + self.min_interval - time.monotonic()
+        if wait <= 0 or _loop is None:
+            self._last_draw = time.monotonic()
+            self.update_display()
+        elif not self._redraw_pending:
+            self._redraw_pending = True
+            call_later(wait, self._deferred_redraw)
+
+    def _deferred_redraw(self):
+        self._redraw_pending = False
+        self._last_draw = time.monotonic()
+        self.update_display()
+
+    def _value_text(self) -> str:
+        if self.value is None:
+            return "--"
+        return f"{self.value:.1f}{self.unit}" if abs(self.value) < 100 else f"{self.value:.0f}{self.unit}"
+
+    def cache_key(self) -> tuple:
+        return super().cache_key() + (self.label, self._value_text(), self.range, self.line_color)
+
+    def cacheable(self) -> bool:
+        # Gauges are a function of the value and cache well, as is a sparkline
+        # with no line to draw yet (e.g. at startup); after that they never repeat
+        return self.style == "gauge" or self.history.total < 2
+
+    def prerender(self):
+        if self.style == "gauge":
+            self.render_native()
+
+    def render(self) -> Image.Image:
+        if self.deck is None:
+            return None
+        image = PILHelper.create_image(self.deck, background=self.bg_color)
+        draw = ImageDraw.Draw(image)
+        if self.style == "gauge":
+            self._draw_gauge(image, draw)
+        else:
+            self._draw_sparkline(image, draw)
+        return image
+
+    def _draw_centered(self, draw, y: int, text: str, font, width: int):
+        bbox = draw.textbbox((0, 0), text, font=font)
+        draw.text(((width - (bbox[2] - bbox[0])) // 2, y), text, font=font, fill="white")
+
+    def _draw_gauge(self, image: Image.Image, draw: ImageDraw.ImageDraw):
+        """270° arc from min_value to max_value with the value in the middle."""
+        low, high = self.range
+        low = 0.0 if low is None else low
+        high = 100.0 if high is None else high
+        box = (6, 6, image.width - 6, image.height - 6)
+        draw.arc(box, 135, 405, fill="#455a64", width=6)
+        if self.value is not None and high > low:
+            fraction = min(1.0, max(0.0, (self.value - low) / (high - low)))
+            if fraction > 0:
+                draw.arc(box, 135, 135 + 270 * fraction, fill=self.line_color, width=6)
+        self._draw_centered(draw, image.height // 2 - 9, self._value_text(),
+                            _assets.font(FONT_SIZE), image.width)
+        if self.label:
+            self._draw_centered(draw, image.height - 18, self.label,
+                                _assets.font(FONT_SIZE_SMALL), image.width)
+
+    def _draw_sparkline(self, image: Image.Image, draw: ImageDraw.ImageDraw):
+        """Label and value on top, history plot below."""
+        font = _assets.font(FONT_SIZE_SMALL)
+        if self.label:
+            self._draw_centered(draw, 2, self.label, font, image.width)
+        self._draw_centered(draw, 17, self._value_text(), _assets.font(FONT_SIZE), image.width)
+        top = 36
+        plot = self._update_plot(image.width, image.height - top - 2)
+        if plot is not None:
+            image.paste(plot, (0, top), plot)
+
+    def _update_plot(self, width: int, height: int) -> Image.Image | None:
+        """Bring the plot up to date: scroll in new samples, or repaint on a rescale."""
+        columns = width // SPARKLINE_STEP + 1
+        values, total = self.history.latest(columns)
+        if not values:
+            return None
+        new = total - self._plot_total
+        if self._plot is not None and new == 0:
+            return self._plot
+
+        scale = self._plot_scale
+        fresh = values[-new:] if 0 < new < len(values) else values
+        fit_low, fit_high = min(values), max(values)
+        if self.range[0] is not None and self.range[1] is not None:
+            wanted = self.range
+        elif (scale is None or min(fresh) < scale[0] or max(fresh) > scale[1]
+              or (scale[1] - scale[0]) > 2 * max(fit_high - fit_low, 1e-9)):
+            # Out of range, or zoomed far out after the extremes scrolled away
+            pad = max((fit_high - fit_low) * 0.1, 0.05)
+            wanted = (fit_low - pad if self.range[0] is None else self.range[0],
+                      fit_high + pad if self.range[1] is None else self.range[1])
+        else:
+            wanted = scale
+
+        repaint = (self._plot is None or self._plot.size != (width, height)
+                   or wanted != scale or new >= len(values))
+        if repaint:
+            self._plot = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+            self._plot_scale = wanted
+            segments = len(values) - 1
+        else:
+            # Scroll left by the new samples and clear the strip they land in
+            shift = new * SPARKLINE_STEP
+            self._plot.paste(self._plot.crop((shift, 0, width, height)), (0, 0))
+            ImageDraw.Draw(self._plot).rectangle((width - shift, 0, width, height), fill=(0, 0, 0, 0))
+            segments = new
+
+        draw = ImageDraw.Draw(self._plot)
+        low, high = self._plot_scale
+        span = (high - low) or 1.0
+
+        def point(index: int) -> tuple[int, int]:
+            x = width - 1 - (len(values) - 1 - index) * SPARKLINE_STEP
+            fraction = min(1.0, max(0.0, (values[index] - low) / span))
+            return x, round((height - 1) * (1 - fraction))
+
+        fill = self.line_color + "50"  # Same color, translucent
+        for index in range(len(values) - segments, len(values)):
+            if index == 0:
+                continue
+            (x0, y0), (x1, y1) = point(index - 1), point(index)
+            draw.polygon([(x0, y0), (x1, y1), (x1, height), (x0, height)], fill=fill)
+            draw.line([(x0, y0), (x1, y1)], fill=self.line_color, width=2)
+        self._plot_total = total
+        return self._plot
+
+    def on_press(self):
+        """Show the newest value now, skipping the rate limit."""
+        self._last_draw = time.monotonic()
+        self.update_display()
+
+    def on_release(self):
+        pass
+
+
+# === Button Layout ===
+# Layouts live in a TOML (or JSON) file: named pages of keys, each key
+# naming a button type and its constructor options. Top-level pages apply
+# to any deck; [decks.<serial>] sections give a specific deck its own.
+# A layout is validated and compiled once into an immutable Layout; its
+# digest is the hash of the file, so reloading an unchanged file is a no-op.
+
+BUTTON_TYPES: dict[str, type[Button]] = {
+    "blank": Button,
+    "command": CommandButton,
+    "ha": HAButton,
+    "ha_state": StatefulHAButton,
+    "volume": VolumeButton,
+    "trv": TRVButton,
+    "sensor": SensorTileButton,
+    "local": LocalStateButton,
+    "page": PageButton,
+    "back": BackButton,
+}
+
+# Options a per-state override (StatefulHAButton states) may set
+STYLE_FIELDS = frozenset({"bg_color", "icon", "text"})
+# Options of an HAButton long_press / double_tap alternate
+ALTERNATE_FIELDS = frozenset({"service", "entity_id", "data"})
+
+
+class LayoutError(ValueError):
+    """The layout file is missing, unparsable or fails validation."""
+
+
+@dataclass(frozen=True)
+class KeySpec:
+    key: int
+    type: str
+    options: Mapping[str, Any]
+
+    def build(self, transparent: bool = False) -> Button:
+        """Instantiate the button.
+
+        transparent leaves out the default bg_color so a page background shows
+        through; a bg_color set in the layout still wins.
+        """
+        cls = BUTTON_TYPES[self.type]
+        options = _thaw(self.options)
+        if transparent and cls.see_through:
+            options.setdefault("bg_color", None)
+        return cls(self.key, **options)
+
+
+@dataclass(frozen=True)
+class Page:
+    name: str
+    keys: tuple[KeySpec, ...]
+    background: str | None = None  # Image (or GIF/APNG animation) spanning all keys
+
+
+@dataclass(frozen=True)
+class DeckLayout:
+    start_page: str
+    pages: Mapping[str, Page]
+    encoding: EncodeSettings = EncodeSettings()
+
+    def build_pages(self, key_count: int) -> dict[str, dict[int, Button]]:
+        """Instantiate every page's buttons, dropping keys the deck doesn't have."""
+        pages = {}
+        for name, page in self.pages.items():
+            transparent = page.background is not None
+            pages[name] = {spec.key: spec.build(transparent) for spec in page.keys if spec.key < key_count}
+            if transparent:
+                # Empty keys show their part of the background
+                for key in range(key_count):
+                    pages[name].setdefault(key, Button(key, bg_color=None))
+            for button in pages[name].values():
+                button.page = name
+        return pages
+
+    def backgrounds(self) -> dict[str, str]:
+        return {name: page.background for name, page in self.pages.items() if page.background}
+
+
+@dataclass(frozen=True)
+class Layout:
+    path: Path
+    digest: str
+    default: DeckLayout | None
+    decks: Mapping[str, DeckLayout]  # by serial number
+
+    def for_serial(self, serial: str) -> DeckLayout:
+        deck_layout = self.decks.get(serial, self.default)
+        if deck_layout is None:
+            raise LayoutError(f"no [decks.{serial}] section and no default pages")
+        return deck_layout
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def _thaw(value):
+    if isinstance(value, Mapping):
+        return {k: _thaw(v) for k, v in value.items()}
+    if isinstance(value, tuple):
+        return [_thaw(v) for v in value]
+    return value
+
+
+def _button_options(cls: type[Button]) -> tuple[set[str], set[str]]:
+    """(allowed, required) constructor options of a button class, excluding key."""
+    allowed, required = set(), set()
+    own_init = True
+    for klass in cls.__mro__:
+        init = klass.__dict__.get("__init__")
+        if init is None or klass is object:
+            continue
+        for param in inspect.signature(init).parameters.values():
+            if param.name in ("self", "key") or param.kind in (param.VAR_KEYWORD, param.VAR_POSITIONAL):
+                continue
+            allowed.add(param.name)
+            if own_init and param.default is param.empty:
+                required.add(param.name)
+        own_init = False
+    return allowed, required
+
+
+def _check_style(where: str, options: dict):
+    color = options.get("bg_color")
+    if color is not None and not (isinstance(color, str) and len(color) == 7 and color[0] == "#"
+                                  and all(c in "0123456789abcdefABCDEF" for c in color[1:])):
+        raise LayoutError(f"{where}: bg_color must be #rrggbb, got {color!r}")
+    icon = options.get("icon")
+    if icon:
+        # Bare file names refer to ICONS_DIR
+        options["icon"] = str(ICONS_DIR / icon) if not Path(icon).is_absolute() else icon
+
+
+def _compile_key(page: str, key: str, options: dict) -> KeySpec:
+    where = f"page {page!r} key {key}"
+    try:
+        index = int(key)
+    except ValueError:
+        raise LayoutError(f"{where}: key must be an integer") from None
+    if index < 0:
+        raise LayoutError(f"{where}: key must be >= 0")
+    if not isinstance(options, dict):
+        raise LayoutError(f"{where}: expected a table")
+
+    options = dict(options)
+    kind = options.pop("type", "blank")
+    cls = BUTTON_TYPES.get(kind)
+    if cls is None:
+        raise LayoutError(f"{where}: unknown type {kind!r} (one of {', '.join(BUTTON_TYPES)})")
+    allowed, required = _button_options(cls)
+    if unknown := set(options) - allowed:
+        raise LayoutError(f"{where}: unknown option(s) for {kind!r}: {', '.join(sorted(unknown))}")
+    if missing := required - set(options):
+        raise LayoutError(f"{where}: {kind!r} requires {', '.join(sorted(missing))}")
+
+    for name, choices in cls.option_choices.items():
+        if name in options and options[name] not in choices:
+            raise LayoutError(f"{where}: {name} must be one of {', '.join(choices)}, got {options[name]!r}")
+
+    _check_style(where, options)
+    states = options.get("states")
+    if states is not None:
+        if not isinstance(states, dict) or not all(isinstance(v, dict) for v in states.values()):
+            raise LayoutError(f"{where}: states must map state names to tables")
+        options["states"] = states = {name: dict(style) for name, style in states.items()}
+        for name, style in states.items():
+            if bad := set(style) - STYLE_FIELDS:
+                raise LayoutError(f"{where} state {name!r}: unknown option(s) {', '.join(sorted(bad))}")
+            _check_style(f"{where} state {name!r}", style)
+
+    for gesture in ("long_press", "double_tap"):
+        alternate = options.get(gesture)
+        if alternate is None:
+            continue
+        if not isinstance(alternate, dict) or "/" not in str(alternate.get("service", "")):
+            raise LayoutError(f'{where}: {gesture} must be a table with service = "domain/service"')
+        if bad := set(alternate) - ALTERNATE_FIELDS:
+            raise LayoutError(f"{where} {gesture}: unknown option(s) {', '.join(sorted(bad))}")
+        if not isinstance(alternate.get("data", {}), dict):
+            raise LayoutError(f"{where} {gesture}: data must be a table")
+
+    return KeySpec(index, kind, _freeze(options))
+
+
+def _compile_encoding(where: str, data: dict, base: EncodeSettings) -> EncodeSettings:
+    """An [encoding] table over base (the layout-wide settings for a deck section)."""
+    table = data.get("encoding", {})
+    if not isinstance(table, dict):
+        raise LayoutError(f"{where}: encoding must be a table")
+    unknown = set(table) - {"quality", "subsampling"}
+    if unknown:
+        raise LayoutError(f"{where}: unknown encoding option(s): {', '.join(sorted(unknown))}")
+    quality = table.get("quality", base.quality)
+    if not isinstance(quality, int) or isinstance(quality, bool) or not 1 <= quality <= 100:
+        raise LayoutError(f"{where}: encoding quality must be an integer from 1 to 100")
+    subsampling = table.get("subsampling", base.subsampling)
+    if subsampling not in JPEG_SUBSAMPLINGS:
+        raise LayoutError(f"{where}: encoding subsampling must be one of {', '.join(JPEG_SUBSAMPLINGS)}")
+    return EncodeSettings(quality, subsampling)
+
+
+def _compile_deck(where: str, data: dict, encoding: EncodeSettings) -> DeckLayout:
+    pages_data = data.get("pages")
+    if not isinstance(pages_data, dict) or not pages_data:
+        raise LayoutError(f"{where}: needs at least one [pages.<name>] table")
+
+    pages = {}
+    for name, page in pages_data.items():
+        keys = page.get("keys", {}) if isinstance(page, dict) else None
+        if not isinstance(keys, dict):
+            raise LayoutError(f"{where}: page {name!r}: expected a keys table")
+        try:
+            specs = tuple(sorted((_compile_key(name, k, v) for k, v in keys.items()),
+                                 key=lambda s: s.key))
+        except LayoutError as e:
+            raise LayoutError(f"{where}: {e}") from None
+        background = page.get("background")
+        if background is not None:
+            if not isinstance(background, str) or not background:
+                raise LayoutError(f"{where}: page {name!r}: background must be an image file name")
+            # Bare file names refer to ICONS_DIR, like icons
+            background = str(ICONS_DIR / background) if not Path(background).is_absolute() else background
+        pages[name] = Page(name, specs, background)
+
+    start_page = data.get("start_page", next(iter(pages)))
+    if start_page not in pages:
+        raise LayoutError(f"{where}: start_page {start_page!r} is not a page")
+    for page in pages.values():
+        for spec in page.keys:
+            if spec.type == "page" and spec.options["target"] not in pages:
+                raise LayoutError(f"{where}: page {page.name!r} key {spec.key}: "
+                                  f"target {spec.options['target']!r} is not a page")
+    # A deck section's own [decks.<serial>.encoding] overrides the layout's
+    return DeckLayout(start_page, MappingProxyType(pages), _compile_encoding(where, data, encoding))
+
+
+def compile_layout(data: dict, path: Path, digest: str) -> Layout:
+    """Validate parsed layout data and freeze it into a Layout."""
+    encoding = _compile_encoding("layout", data, EncodeSettings())
+    default = _compile_deck("layout", data, encoding) if "pages" in data else None
+    decks_data = data.get("decks", {})
+    if not isinstance(decks_data, dict):
+        raise LayoutError("decks must be a table of [decks.<serial>] sections")
+    decks = {serial: _compile_deck(f"deck {serial}", deck, encoding) for serial, deck in decks_data.items()}
+    if default is None and not decks:
+        raise LayoutError("layout needs [pages.<name>] or [decks.<serial>] tables")
+    return Layout(path, digest, default, MappingProxyType(decks))
+
+
+def load_layout(path: Path = LAYOUT_FILE) -> Layout:
+    """Read and compile a TOML or JSON layout file."""
+    try:
+        raw = path.read_bytes()
+    except OSError as e:
+        raise LayoutError(f"cannot read {path}: {e}") from None
+    try:
+        data = json.loads(raw) if path.suffix == ".json" else tomllib.loads(raw.decode())
+    except (ValueError, tomllib.TOMLDecodeError) as e:
+        raise LayoutError(f"cannot parse {path}: {e}") from None
+    return compile_layout(data, path, hashlib.sha256(raw).hexdigest())
 
 
 # === Home Assistant WebSocket ===
 
-async def ha_websocket_loop(buttons: dict[int, Button]):
+def _reconnect_delay(failures: int) -> float:
+    """Jittered exponential backoff: ~0.25-0.5s first, doubling up to RECONNECT_MAX_DELAY."""
+    return min(RECONNECT_MAX_DELAY, RECONNECT_MIN_DELAY * 2 ** failures) * random.uniform(0.5, 1.0)
+
+
+async def _wait_for_new_token(rejected: str | None) -> str:
+    """Poll the token file until it holds a token other than the rejected one (or any, for None)."""
+    while True:
+        await asyncio.sleep(AUTH_RETRY_POLL)
+        token = get_ha_token()
+        if token is not None and token != rejected:
+            print(f"New token in {HA_TOKEN_FILE}, connecting", flush=True)
+            return token
+
+
+async def snapshot_loop():
+    """Periodically persist the entity store so restarts paint instantly."""
+    while True:
+        await asyncio.sleep(SNAPSHOT_INTERVAL)
+        _entities.save_snapshot(ENTITY_SNAPSHOT)
+
+
+async def ha_websocket_loop():
     """Connect to HA websocket and update buttons in real-time."""
-    global _ws_queue, _ws_loop
-    _ws_loop = asyncio.get_event_loop()
-    _ws_queue = asyncio.Queue()
+    import aiohttp
+
+    global _ws_resubscribe
+    _ws_resubscribe = asyncio.Event()
+    _commands.attach(asyncio.get_running_loop())
 
     token = get_ha_token()
+    if token is None:
+        # The decks keep working without HA; connect once the token shows up
+        print(f"ERROR: Token file missing or empty: {HA_TOKEN_FILE}", file=sys.stderr, flush=True)
+        token = await _wait_for_new_token(None)
+    rejected = None
 
-    # Build entity -> button mapping for reactive updates
-    entity_button_map = {}  # entity_id -> list of TRVButton
-    for b in buttons.values():
-        if isinstance(b, TRVButton):
-            for eid in b.watched_entities:
-                entity_button_map.setdefault(eid, []).append(b)
+    # Consecutive failed attempts; reset once authenticated
+    failures = 0
+    first = True
 
     while True:
+        if rejected is not None:
+            token = await _wait_for_new_token(rejected)
+            rejected = None
+            failures = 0
+        if not first:
+            delay = _reconnect_delay(failures)
+            print(f"Reconnecting in {delay:.1f}s...", flush=True)
+            await asyncio.sleep(delay)
+            failures += 1
+            _metrics.inc("streamdeck_ha_reconnects_total")
+        first = False
+
         try:
             async with aiohttp.ClientSession() as session:
                 async with session.ws_connect(
@@ -364,65 +2879,100 @@ async def ha_websocket_loop(buttons: dict[int, Button]):
                     await ws.send_json({"type": "auth", "access_token": token})
                     msg = await ws.receive_json()
                     if msg.get("type") != "auth_ok":
-                        print(f"Auth failed: {msg}", flush=True)
-                        await asyncio.sleep(10)
+                        print(f"Auth failed: {msg}; waiting for a new token in {HA_TOKEN_FILE}", flush=True)
+                        rejected = token
                         continue
 
                     print("Authenticated with Home Assistant", flush=True)
+                    failures = 0
 
                     # Fresh msg_id per connection
                     msg_id = 1
+                    _ws_resubscribe.clear()
+
+                    subscription_id = None
+
+                    async def subscribe():
+                        """Subscribe to the watched entities, replacing any current subscription.
+
+                        HA filters server-side and the first event carries their full
+                        current state, so no get_states. (An empty entity_ids list would
+                        subscribe to everything.) Events still in flight for the old
+                        subscription carry its id and are ignored.
+                        """
+                        nonlocal msg_id, subscription_id
+                        if subscription_id is not None:
+                            old, subscription_id = subscription_id, None
+                            await ws.send_json({"id": msg_id, "type": "unsubscribe_events", "subscription": old})
+                            msg_id += 1
+                        if _entities.watched():
+                            subscription_id = msg_id
+                            msg_id += 1
+                            await ws.send_json({
+                                "id": subscription_id,
+                                "type": "subscribe_entities",
+                                "entity_ids": _entities.watched(),
+                            })
 
-                    # Get initial states
-                    await ws.send_json({"id": msg_id, "type": "get_states"})
-                    msg_id += 1
+                    await subscribe()
 
-                    # Subscribe to state changes
-                    await ws.send_json({
-                        "id": msg_id,
-                        "type": "subscribe_events",
-                        "event_type": "state_changed",
-                    })
-                    msg_id += 1
+                    # msg_id -> service call awaiting its result frame
+                    in_flight: dict[int, dict] = {}
 
                     async def send_queued_commands():
                         """Send queued service calls over WS."""
                         nonlocal msg_id
                         while True:
-                            cmd = await _ws_queue.get()
+                            cmd = await _commands.get()
+                            cmd["sent_at"] = time.perf_counter()
+                            cmd_id, msg_id = msg_id, msg_id + 1
+                            in_flight[cmd_id] = cmd
                             await ws.send_json({
-                                "id": msg_id,
+                                "id": cmd_id,
                                 "type": "call_service",
                                 "domain": cmd["domain"],
                                 "service": cmd["service"],
                                 "service_data": cmd["service_data"],
                             })
-                            msg_id += 1
+
+                    async def resubscribe_on_request():
+                        """Follow layout reloads that change the watched entities.
+
+                        Done on the open connection, so service calls in flight
+                        still get their results.
+                        """
+                        while True:
+                            await _ws_resubscribe.wait()
+                            _ws_resubscribe.clear()
+                            await subscribe()
+
+                    record = open(WS_RECORD_FILE, "a") if WS_RECORD_FILE else None
 
                     async def receive_messages():
                         """Process incoming WS messages."""
                         async for msg in ws:
                             if msg.type == aiohttp.WSMsgType.TEXT:
-                                data = json.loads(msg.data)
-
-                                if data.get("type") == "result" and data.get("success"):
-                                    result = data.get("result", [])
-                                    if isinstance(result, list):
-                                        for state in result:
-                                            entity_id = state.get("entity_id")
-                                            if entity_id in entity_button_map:
-                                                for btn in entity_button_map[entity_id]:
-                                                    btn.update_entity(entity_id, state)
-
-                                elif data.get("type") == "event":
-                                    event = data.get("event", {})
-                                    if event.get("event_type") == "state_changed":
-                                        event_data = event.get("data", {})
-                                        entity_id = event_data.get("entity_id")
-                                        if entity_id in entity_button_map:
-                                            new_state = event_data.get("new_state", {})
-                                            for btn in entity_button_map[entity_id]:
-                                                btn.update_entity(entity_id, new_state)
+                                if record:
+                                    record.write(msg.data + "\n")
+                                _metrics.inc("streamdeck_ws_messages_total")
+                                start = time.perf_counter()
+                                data = _loads(msg.data)
+                                _metrics.observe("streamdeck_ws_decode_seconds", time.perf_counter() - start)
+
+                                if data.get("type") == "event" and data.get("id") == subscription_id:
+                                    _entities.apply_compressed(data.get("event", {}))
+
+                                elif data.get("type") == "result" and data.get("id") in in_flight:
+                                    cmd = in_flight.pop(data.get("id"))
+                                    _metrics.observe("streamdeck_ha_call_seconds",
+                                                     time.perf_counter() - cmd["sent_at"])
+                                    _report_result(cmd, data.get("success"), data.get("error"))
+
+                                else:
+                                    # Events of a replaced subscription, (un)subscribe acks, ...
+                                    _metrics.inc("streamdeck_ws_messages_dropped_total")
+                                    if data.get("type") == "result" and not data.get("success"):
+                                        print(f"HA request {data.get('id')} failed: {data.get('error')}", flush=True)
 
                             elif msg.type in (
                                 aiohttp.WSMsgType.ERROR,
@@ -432,21 +2982,27 @@ async def ha_websocket_loop(buttons: dict[int, Button]):
                                 print(f"WS closed: {msg.type}", flush=True)
                                 return
 
-                    # Run sender and receiver concurrently; if either exits, reconnect
-                    done, pending = await asyncio.wait(
-                        [
-                            asyncio.create_task(send_queued_commands()),
-                            asyncio.create_task(receive_messages()),
-                        ],
-                        return_when=asyncio.FIRST_COMPLETED,
-                    )
-                    for task in pending:
-                        task.cancel()
-                    for task in done:
-                        if task.exception():
-                            print(f"WS task error: {task.exception()}", flush=True)
-
-                    print("WS loop exited", flush=True)
+                    # Run sender, receiver and resubscriber concurrently; if any exits, reconnect.
+                    # The cleanup also runs when the daemon cancels this loop on shutdown.
+                    tasks = [
+                        asyncio.create_task(send_queued_commands()),
+                        asyncio.create_task(receive_messages()),
+                        asyncio.create_task(resubscribe_on_request()),
+                    ]
+                    try:
+                        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                        for task in done:
+                            if task.exception():
+                                print(f"WS task error: {task.exception()}", flush=True)
+                    finally:
+                        for task in tasks:
+                            task.cancel()
+                        await asyncio.gather(*tasks, return_exceptions=True)
+                        if record:
+                            record.close()
+                        for cmd in in_flight.values():
+                            _report_result(cmd, False, "connection lost before result")
+                        print("WS loop exited", flush=True)
 
         except aiohttp.ClientError as e:
             print(f"Connection error: {e}", flush=True)
@@ -457,146 +3013,519 @@ async def ha_websocket_loop(buttons: dict[int, Button]):
             print(f"Unexpected error: {e}", flush=True)
             traceback.print_exc()
 
-        print("Reconnecting in 5s...", flush=True)
-        await asyncio.sleep(5)
+
+# === Screensaver ===
+
+class Screensaver:
+    """One deck's idle state machine (awake -> dimmed -> off) on event-loop timers.
+
+    A key press only stamps last_activity. The single pending timer fires at the
+    exact deadline and re-arms itself from last_activity if there was a press
+    meanwhile, so an idle deck costs nothing. Presses and timers both run on
+    the event loop, so a press can't slip between a deadline check and a
+    transition.
+    """
+
+    def __init__(self, writer: DeckWriter):
+        self.writer = writer
+        self.state = "awake"
+        self.last_activity = time.monotonic()
+        self._timer: asyncio.TimerHandle | None = None
+        self._fade_gen = 0  # Bumped to abandon the steps of a running fade
+        self._stopped = False
+
+    def start(self):
+        self._arm()
+
+    def stop(self):
+        self._stopped = True
+        self._fade_gen += 1
+        self._arm()
+
+    def activity(self) -> bool:
+        """Record a key press; True if it woke the deck."""
+        self.last_activity = time.monotonic()
+        if self.state == "awake":
+            return False
+        self._wake()
+        return True
+
+    def wake(self):
+        self.last_activity = time.monotonic()
+        if self.state != "awake":
+            self._wake()
+
+    def dim(self):
+        """Dim now (desktop went idle); the off deadline still runs from last_activity."""
+        if self.state == "awake":
+            self._dim()
+        self._arm()
+
+    def sleep(self):
+        """Turn the deck off now (desktop locked)."""
+        if self.state != "off":
+            self._off()
+        self._arm()
+
+    # Transitions. Waking is instant, going down fades.
+
+    def _wake(self):
+        if self.state == "off":
+            self.writer.unblank()
+        self.state = "awake"
+        self._fade_gen += 1
+        self.writer.set_brightness(100)
+        self._arm()
+
+    def _dim(self):
+        self.state = "dimmed"
+        self._fade(SCREENSAVER_DIM_LEVEL)
+        print(_render_cache.stats(), flush=True)
+
+    def _off(self):
+        # Updates keep landing in the framebuffers, not on the black keys
+        self.state = "off"
+        self._fade(0, then=self.writer.blank if SCREENSAVER_BLANK_KEYS else self.writer.hold)
+
+    def _fade(self, level: int, then=None):
+        """Step brightness to level in SCREENSAVER_FADE_STEPS writes over SCREENSAVER_FADE_TIME."""
+        self._fade_gen += 1
+        loop = asyncio.get_running_loop()
+        start = self.writer.brightness if self.writer.brightness is not None else 100
+        for i in range(1, SCREENSAVER_FADE_STEPS + 1):
+            step = round(start + (level - start) * i / SCREENSAVER_FADE_STEPS)
+            loop.call_later(SCREENSAVER_FADE_TIME * i / SCREENSAVER_FADE_STEPS, self._fade_step,
+                            self._fade_gen, step, then if i == SCREENSAVER_FADE_STEPS else None)
+
+    def _fade_step(self, gen: int, level: int, then):
+        if gen != self._fade_gen:
+            return
+        self.writer.set_brightness(level)
+        if then:
+            then()
+
+    # Timer
+
+    def _arm(self):
+        """(Re)schedule the timer at the current state's deadline."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        timeout = {"awake": SCREENSAVER_DIM_TIMEOUT, "dimmed": SCREENSAVER_OFF_TIMEOUT}.get(self.state)
+        if timeout is None or self._stopped:
+            return
+        # loop.time() is time.monotonic()
+        self._timer = asyncio.get_running_loop().call_at(self.last_activity + timeout, self._expire)
+
+    def _expire(self):
+        self._timer = None
+        idle = time.monotonic() - self.last_activity
+        if self.state == "awake" and idle >= SCREENSAVER_DIM_TIMEOUT:
+            self._dim()
+        elif self.state == "dimmed" and idle >= SCREENSAVER_OFF_TIMEOUT:
+            self._off()
+        self._arm()
+
+
+async def logind_watch(on_idle, on_lock):
+    """Follow the desktop session's IdleHint and lock state via logind.
+
+    Optional: without dbus-next or a graphical session the screensaver runs on
+    key activity alone.
+    """
+    try:
+        from dbus_next import BusType
+        from dbus_next.aio import MessageBus
+    except ImportError:
+        print("dbus-next not installed, screensaver follows key presses only", flush=True)
+        return
+
+    login1 = "org.freedesktop.login1"
+    try:
+        bus = await MessageBus(bus_type=BusType.SYSTEM).connect()
+        path = "/org/freedesktop/login1/user/self"
+        user = bus.get_proxy_object(login1, path, await bus.introspect(login1, path))
+        _, path = await user.get_interface("org.freedesktop.login1.User").get_display()
+        if path == "/":
+            print("No graphical session, screensaver follows key presses only", flush=True)
+            bus.disconnect()
+            return
+        session = bus.get_proxy_object(login1, path, await bus.introspect(login1, path))
+    except Exception as e:
+        print(f"logind unavailable ({e}), screensaver follows key presses only", flush=True)
+        return
+
+    def properties_changed(interface, changed, invalidated):
+        if "LockedHint" in changed:
+            on_lock(changed["LockedHint"].value)
+        if "IdleHint" in changed:
+            on_idle(changed["IdleHint"].value)
+
+    session.get_interface("org.freedesktop.DBus.Properties").on_properties_changed(properties_changed)
+    session_iface = session.get_interface("org.freedesktop.login1.Session")
+    session_iface.on_lock(lambda: on_lock(True))
+    session_iface.on_unlock(lambda: on_lock(False))
+    print(f"Following logind session {path}", flush=True)
+    await bus.wait_for_disconnect()
+
+
+# === Gestures ===
+# Turns key down/up events into button calls. Keys without alternates act on
+# key down as before; a key with long_press / double_tap only shows its
+# pressed look until the gesture is decided, so its tap fires on release (or
+# once the double-tap window closes). Held repeat keys step again at a rate
+# that speeds up the longer they are held. Every wait is a loop.call_at
+# timer on the monotonic clock, so held and idle keys cost nothing between
+# deadlines.
+
+class GestureRecognizer:
+    """One deck's long-press, double-tap and hold-to-repeat state."""
+
+    def __init__(self):
+        # Button each key went down on, so the release reaches it after a page switch
+        self._held: dict[int, Button] = {}
+        self._timers: dict[int, asyncio.TimerHandle] = {}  # key -> pending long press / repeat
+        self._consumed: set[int] = set()  # held keys that already fired an alternate
+        self._taps: dict[int, tuple[Button, asyncio.TimerHandle]] = {}  # first taps awaiting a second
+
+    def down(self, key: int, button: Button):
+        self._held[key] = button
+        if not (button.long_press or button.double_tap):
+            button.on_press()
+            if button.repeat:
+                deadline = time.monotonic() + REPEAT_DELAY
+                self._schedule(key, deadline, self._repeat, key, button, 1, deadline, REPEAT_INTERVAL)
+            return
+
+        button.press_feedback(True)
+        tap = self._taps.get(key)
+        if tap is not None and tap[0] is button:
+            del self._taps[key]
+            tap[1].cancel()
+            self._consumed.add(key)
+            _metrics.inc("streamdeck_double_taps_total")
+            button.on_double_tap()
+        elif button.long_press:
+            self._schedule(key, time.monotonic() + LONG_PRESS_TIME, self._long_press, key, button)
+
+    def up(self, key: int):
+        self._cancel(key)
+        button = self._held.pop(key, None)
+        if button is None:
+            return
+        if not (button.long_press or button.double_tap):
+            button.on_release()
+            return
+
+        button.press_feedback(False)
+        if key in self._consumed:
+            self._consumed.discard(key)
+        elif button.double_tap:
+            handle = asyncio.get_running_loop().call_later(DOUBLE_TAP_WINDOW, self._tap, key, button)
+            self._taps[key] = (button, handle)
+        else:
+            self._tap(key, button)
+
+    def cancel(self):
+        """Drop every pending timer (deck closing)."""
+        for handle in self._timers.values():
+            handle.cancel()
+        for _, handle in self._taps.values():
+            handle.cancel()
+        self._timers.clear()
+        self._taps.clear()
+        self._held.clear()
+        self._consumed.clear()
+
+    def _schedule(self, key: int, deadline: float, callback, *args):
+        # loop.time() is time.monotonic()
+        self._timers[key] = asyncio.get_running_loop().call_at(deadline, callback, *args)
+
+    def _cancel(self, key: int):
+        handle = self._timers.pop(key, None)
+        if handle is not None:
+            handle.cancel()
+
+    def _tap(self, key: int, button: Button):
+        if self._taps.get(key, (None,))[0] is button:
+            del self._taps[key]
+        button.on_press()
+        button.on_release()
+
+    def _long_press(self, key: int, button: Button):
+        self._timers.pop(key, None)
+        self._consumed.add(key)
+        _metrics.inc("streamdeck_long_presses_total")
+        button.on_long_press()
+
+    def _repeat(self, key: int, button: Button, count: int, deadline: float, interval: float):
+        _metrics.inc("streamdeck_key_repeats_total")
+        button.on_repeat(count)
+        # Next step from the previous deadline so timers don't drift, but never
+        # in the past, so a stalled loop doesn't catch up in a burst
+        deadline = max(deadline + interval, time.monotonic())
+        interval = max(REPEAT_MIN_INTERVAL, interval * REPEAT_ACCELERATION)
+        self._schedule(key, deadline, self._repeat, key, button, count + 1, deadline, interval)
+
+
+# === Deck Controller ===
+# One per connected StreamDeck: its own writer, pages and screensaver
+# state. The HA connection and the entity store are shared by all decks.
+
+class DeckController:
+    """Drives one StreamDeck device."""
+
+    def __init__(self, deck):
+        self.deck = deck
+        self.path = deck.id()
+        self.serial = self.path
+        self.writer = DeckWriter(deck)
+        self.gestures = GestureRecognizer()
+        self.screensaver = Screensaver(self.writer)
+
+    async def open(self, layout: Layout) -> bool:
+        """Open the device and show its layout; True if the watched entities changed."""
+        await asyncio.get_running_loop().run_in_executor(_usb, self._open_device)
+        print(f"Connected to {self.deck.deck_type()} {self.serial} ({self.deck.key_count()} keys)",
+              flush=True)
+        self.writer.start()
+        changed = self.apply_layout(layout)
+        self.writer.set_brightness(100)
+        self.screensaver.start()
+        self.deck.set_key_callback(self.key_callback)
+        return changed
+
+    def _open_device(self):
+        """USB executor: open and reset the deck, read its serial."""
+        self.deck.open()
+        self.deck.reset()
+        try:
+            self.serial = self.deck.get_serial_number() or self.path
+        except Exception:
+            pass
+
+    async def close(self, reset: bool = True) -> bool:
+        """Stop driving the device; True if the watched entities changed."""
+        changed = _entities.remove_subscribers(self.serial)
+        self.gestures.cancel()
+        self.screensaver.stop()
+        await self.writer.stop()
+        await asyncio.get_running_loop().run_in_executor(_usb, self._close_device, reset)
+        return changed
+
+    def _close_device(self, reset: bool):
+        try:
+            if reset:
+                self.deck.reset()
+            self.deck.close()
+        except Exception:
+            pass
+
+    def apply_layout(self, layout: Layout) -> bool:
+        """Build and show this deck's pages; True if the watched entities changed."""
+        deck_layout = layout.for_serial(self.serial)
+        pages = deck_layout.build_pages(self.deck.key_count())
+        buttons = [button for page in pages.values() for button in page.values()]
+        for button in buttons:
+            button.deck = self.deck
+            button.writer = self.writer
+        changed = _entities.set_subscribers(self.serial, buttons)
+        self.writer.set_encoding(deck_layout.encoding)
+        self.writer.set_pages(pages, deck_layout.start_page, deck_layout.backgrounds())
+        return changed
+
+    def buttons(self):
+        for page in self.writer.pages.values():
+            yield from page.values()
+
+    def key_callback(self, deck, key, state):
+        """Runs on the library's reader thread: hand the event to the loop, nothing else."""
+        try:
+            _loop.call_soon_threadsafe(self.on_key, key, state, time.perf_counter())
+        except (AttributeError, RuntimeError):
+            pass  # No loop yet, or it closed during shutdown
+
+    def on_key(self, key: int, state: bool, start: float):
+        if state:
+            # A press that wakes the deck doesn't trigger the button (nor its release)
+            if self.screensaver.activity():
+                return
+            button = self.writer.buttons.get(key)
+            if button is not None:
+                self.gestures.down(key, button)
+                _metrics.observe("streamdeck_key_press_seconds", time.perf_counter() - start)
+        else:
+            self.gestures.up(key)
 
 
 # === Main ===
 
 def main():
     global FONT_PATH
-    FONT_PATH = _find_font()
+    _manifest.load()
+    FONT_PATH = _manifest.resolve_font()
     print(f"Font: {FONT_PATH or 'default'}")
+    _assets.preload()
 
-    # Find StreamDeck
-    streamdecks = DeviceManager().enumerate()
-    if not streamdecks:
-        print("No StreamDeck found!")
+    try:
+        layout = load_layout()
+    except LayoutError as e:
+        print(f"ERROR: {e}", file=sys.stderr)
         sys.exit(1)
+    print(f"Layout: {layout.path} ({len(layout.decks)} deck sections, digest {layout.digest[:12]})")
 
-    deck = streamdecks[0]
-    deck.open()
-    deck.reset()
+    # Last known HA states; each deck paints them as soon as it subscribes
+    _entities.load_snapshot(ENTITY_SNAPSHOT)
+    _manifest.save()
 
-    print(f"Connected to {deck.deck_type()} ({deck.key_count()} keys)")
+    asyncio.run(daemon(layout))
 
-    # Set brightness
-    deck.set_brightness(100)
 
-    # Pre-create black image for screensaver
-    black_image = PILHelper.create_image(deck, background="#000000")
-    black_native = PILHelper.to_native_format(deck, black_image)
+# Process start to the first deck painted (None until then)
+_first_paint: float | None = None
+_metrics.gauge("streamdeck_first_paint_seconds", "Process start to the first deck painted",
+               lambda: _first_paint or 0)
 
-    # Create buttons
-    buttons = create_buttons()
-    for button in buttons.values():
-        button.deck = deck
-        button.update_display()
 
+async def daemon(layout: Layout):
+    """Everything runs on this loop; only USB I/O goes to the _usb executor."""
+    global _loop, _first_paint
+    loop = _loop = asyncio.get_running_loop()
+    _assets.watch(loop)
 
-    # Screensaver state: "awake", "dimmed", "off"
-    # Lock protects screensaver state and deck operations
-    deck_lock = threading.Lock()
-    screensaver = {"state": "awake", "last_activity": time.time()}
+    manager = DeviceManager()
+    controllers: dict[str, DeckController] = {}  # by device path
+    unusable: set[str] = set()  # paths that failed to open; retried after replug or reload
+    stopping = asyncio.Event()
 
-    def wake_screen():
-        """Wake from screensaver and restore display."""
-        with deck_lock:
-            if screensaver["state"] != "awake":
-                try:
-                    Button._display_suspended = False  # Allow display updates
-                    deck.set_brightness(100)
-                    for button in buttons.values():
-                        button.update_display()
-                    screensaver["state"] = "awake"  # Only set after success
-                except Exception as e:
-                    print(f"Wake failed: {e}", file=sys.stderr)
-            screensaver["last_activity"] = time.time()
+    def enumerate_decks():
+        """USB executor: current decks by path, and the paths that went away."""
+        found = {deck.id(): deck for deck in manager.enumerate()}
+        gone = {path for path, controller in controllers.items()
+                if path not in found or not controller.deck.connected()}
+        return found, gone
 
-    def dim_screen():
-        """Dim the screen."""
-        with deck_lock:
-            if screensaver["state"] == "awake":
-                try:
-                    deck.set_brightness(30)
-                    screensaver["state"] = "dimmed"
-                except Exception as e:
-                    print(f"Dim failed: {e}", file=sys.stderr)
+    async def sync_devices():
+        """Open newly plugged decks and tear down removed ones."""
+        try:
+            found, gone = await loop.run_in_executor(_usb, enumerate_decks)
+        except Exception as e:
+            print(f"Device enumeration failed: {e}", file=sys.stderr, flush=True)
+            return
+        changed = False
+        unusable.intersection_update(found)
+        for path in gone:
+            controller = controllers.pop(path)
+            print(f"StreamDeck {controller.serial} removed", flush=True)
+            changed |= await controller.close(reset=False)
+        for path, deck in found.items():
+            if path in controllers or path in unusable:
+                continue
+            controller = DeckController(deck)
+            try:
+                changed |= await controller.open(layout)
+            except Exception as e:
+                print(f"Cannot open StreamDeck {path}: {e}", file=sys.stderr, flush=True)
+                await controller.close(reset=False)
+                unusable.add(path)
+                continue
+            controllers[path] = controller
+        if changed:
+            request_ha_resubscribe()
+
+    await sync_devices()
+    if controllers:
+        # Show the cached state before loading the HA stack and D-Bus monitors
+        await asyncio.wait([loop.create_task(c.writer.painted.wait()) for c in controllers.values()],
+                           timeout=5)
+        _first_paint = _process_age()
+        if _first_paint is not None:
+            print(f"First paint {_first_paint * 1000:.0f} ms after start", flush=True)
+    else:
+        print("No StreamDeck found yet, waiting for one to be plugged in", flush=True)
+    # Off the loop, and after the first paint so it does not slow its disk reads
+    loop.run_in_executor(None, _render_cache.prune_disk)
+
+    async def hotplug_loop():
+        while True:
+            await asyncio.sleep(HOTPLUG_POLL_INTERVAL)
+            await sync_devices()
 
-    def screen_off():
-        """Turn screen off - blank all keys and kill backlight."""
-        with deck_lock:
-            if screensaver["state"] != "off":
-                try:
-                    Button._display_suspended = True  # Prevent HA updates drawing over black
-                    deck.set_brightness(0)
-                    # Set all keys to black for LCD longevity
-                    for key in range(deck.key_count()):
-                        deck.set_key_image(key, black_native)
-                    screensaver["state"] = "off"  # Only set after success
-                except Exception as e:
-                    print(f"Screen off failed: {e}", file=sys.stderr)
-
-    # Button callback
-    def key_callback(deck, key, state):
-        # Wake from screensaver on any press
-        if screensaver["state"] != "awake":
-            if state:  # Only wake on press, not release
-                wake_screen()
-            return  # Don't trigger button action when waking
-
-        screensaver["last_activity"] = time.time()
-        if key in buttons:
-            if state:
-                buttons[key].on_press()
-            else:
-                buttons[key].on_release()
+    def on_icon_change(path: str):
+        for controller in controllers.values():
+            for button in controller.buttons():
+                if button.icon == path:
+                    button.update_display()
 
-    deck.set_key_callback(key_callback)
+    _assets.on_change = on_icon_change
 
-    # Screensaver check thread
-    def screensaver_loop():
-        while True:
-            time.sleep(10)  # Check every 10 seconds
-            idle_time = time.time() - screensaver["last_activity"]
-            if screensaver["state"] == "awake" and idle_time > SCREENSAVER_DIM_TIMEOUT:
-                dim_screen()
-            elif screensaver["state"] == "dimmed" and idle_time > SCREENSAVER_OFF_TIMEOUT:
-                screen_off()
-
-    screensaver_thread = threading.Thread(target=screensaver_loop, daemon=True)
-    screensaver_thread.start()
-
-    # Run HA websocket in background
-    def run_ha_loop():
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        loop.run_until_complete(ha_websocket_loop(buttons))
-
-    ha_thread = threading.Thread(target=run_ha_loop, daemon=True)
-    ha_thread.start()
-
-    # Handle shutdown
-    def shutdown(sig, frame):
-        print("\nShutting down...")
-        try:
-            deck.reset()
-            deck.close()
-        except Exception:
-            pass
-        sys.exit(0)
+    # Desktop idle dims every deck, locking turns them off
+    session_locked = False
 
-    signal.signal(signal.SIGINT, shutdown)
-    signal.signal(signal.SIGTERM, shutdown)
+    def each_screensaver(action: str):
+        for controller in controllers.values():
+            getattr(controller.screensaver, action)()
 
-    print("StreamDeck daemon running. Press Ctrl+C to exit.")
+    def on_session_idle(idle: bool):
+        if idle:
+            each_screensaver("dim")
+        elif not session_locked:
+            each_screensaver("wake")
 
-    # Keep main thread alive
-    while True:
+    def on_session_lock(locked: bool):
+        nonlocal session_locked
+        if locked == session_locked:
+            return
+        session_locked = locked
+        each_screensaver("sleep" if locked else "wake")
+
+    # Hot-reload the layout on every deck without reopening the devices
+    def reload_layout():
+        nonlocal layout
         try:
-            signal.pause()
-        except KeyboardInterrupt:
-            shutdown(None, None)
+            new_layout = load_layout(layout.path)
+        except LayoutError as e:
+            print(f"Layout reload failed, keeping current layout: {e}", file=sys.stderr, flush=True)
+            return
+        if new_layout.digest == layout.digest:
+            print("Layout unchanged", flush=True)
+            return
+        layout = new_layout
+        changed = False
+        unusable.clear()  # A deck without a layout may have one now
+        for controller in controllers.values():
+            try:
+                changed |= controller.apply_layout(layout)
+            except LayoutError as e:
+                print(f"StreamDeck {controller.serial}: {e}", file=sys.stderr, flush=True)
+        if changed:
+            request_ha_resubscribe()
+        print(f"Layout reloaded (digest {layout.digest[:12]})", flush=True)
+
+    loop.add_signal_handler(signal.SIGINT, stopping.set)
+    loop.add_signal_handler(signal.SIGTERM, stopping.set)
+    loop.add_signal_handler(signal.SIGHUP, reload_layout)
+    loop.add_signal_handler(signal.SIGUSR1, lambda: print(_metrics.summary(), flush=True))
+
+    # Deck hotplug, HA websocket, local audio/media state and metrics
+    tasks = [loop.create_task(coro) for coro in (
+        hotplug_loop(), ha_websocket_loop(), snapshot_loop(), metrics_server(),
+        logind_watch(on_session_idle, on_session_lock), _pipewire.run(), _mpris.watch())]
+
+    print("StreamDeck daemon running. Press Ctrl+C to exit.", flush=True)
+    await stopping.wait()
+
+    print("\nShutting down...")
+    print(_render_cache.stats(), flush=True)
+    # Cancelling closes the WS session and stops the monitors before the decks go
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    for controller in controllers.values():
+        await controller.close()
+    _entities.save_snapshot(ENTITY_SNAPSHOT)
+    _manifest.save()
+    _usb.shutdown(wait=True)
 
 
 if __name__ == "__main__":
@@ -284,6 +284,7 @@ in
     path = with pkgs; [
       curl
       playerctl
+      pipewire # pw-dump --monitor feeds mute/volume state to the audio keys
       wireplumber
       grim
       slurp
@@ -293,7 +294,9 @@ in
     ];
     serviceConfig = {
       Environment = "PYTHONUNBUFFERED=1";
-      ExecStart = "${pkgs.python3.withPackages (ps: [ ps.aiohttp ps.pillow ps.streamdeck ])}/bin/python3 /home/mike/.local/bin/streamdeck-daemon.py";
+      ExecStart = "${pkgs.python3.withPackages (ps: [ ps.aiohttp ps.dbus-next ps.orjson ps.pillow ps.streamdeck ])}/bin/python3 /home/mike/.local/bin/streamdeck-daemon.py";
+      # Re-reads config/streamdeck/layout.toml without reopening the deck
+      ExecReload = "${pkgs.coreutils}/bin/kill -HUP $MAINPID";
       Restart = "always";
       RestartSec = 5;
     };
@@ -501,7 +504,8 @@ in
 
   # Elgato device udev rules (both Wave:3 and StreamDeck MK.2)
   # - Disable USB autosuspend to prevent random disconnects
-  # - Restart services when devices are reconnected after power cycle
+  # - Restart the Wave:3 audio fix when it is reconnected after power cycle
+  #   (the StreamDeck daemon picks up replugged decks itself)
   services.udev.extraRules = ''
     # Elgato Wave:3 (0fd9:0070)
     ACTION=="add", SUBSYSTEM=="usb", ATTR{idVendor}=="0fd9", ATTR{idProduct}=="0070", ATTR{power/autosuspend}="-1"
@@ -509,7 +513,6 @@ in
 
     # StreamDeck MK.2 (0fd9:0080)
     ACTION=="add", SUBSYSTEM=="usb", ATTR{idVendor}=="0fd9", ATTR{idProduct}=="0080", ATTR{power/autosuspend}="-1"
-    ACTION=="add", SUBSYSTEM=="usb", ATTRS{idVendor}=="0fd9", ATTRS{idProduct}=="0080", TAG+="systemd", ENV{SYSTEMD_USER_WANTS}="streamdeck-restart.service"
   '';
 
   # Service to fix Elgato Wave 3 audio on connect (follows omarchy-fix-usb-audio pattern)
@@ -556,16 +559,6 @@ in
     };
   };
 
-  # Service to restart StreamDeck daemon when device is connected
-  systemd.user.services.streamdeck-restart = {
-    description = "Restart StreamDeck daemon";
-    serviceConfig = {
-      Type = "oneshot";
-      ExecStartPre = "${pkgs.coreutils}/bin/sleep 2";
-      ExecStart = "${pkgs.systemd}/bin/systemctl --user restart streamdeck-daemon";
-    };
-  };
-
   # OpenClaw Samba share automount
   fileSystems."/mnt/openclaw" = {
     device = "//openclaw.local/openclaw";
@@ -5,14 +5,53 @@ Generate ~/.local/state/Beyond All Reason/uikeys.txt with BAR's default
 (typed character) form, so Dvorak users press the key labeled with the
 shortcut letter and BAR recognizes it.
 
-Re-run after BAR updates to resync with upstream defaults.
+--layout dvorak|colemak|azerty instead binds each scancode to the character
+the same physical key types on that layout, so position-based hotkeys (the
+QWE/ASD grid) keep their shape rather than their letters.
+
+Re-run after BAR updates to resync with upstream defaults. The upstream
+files are cached in ~/.cache/bar-gen-uikeys and revalidated with
+ETag/If-Modified-Since, and uikeys.txt is only rewritten when it changes, so
+a run with nothing new upstream is a few conditional requests (cheap enough
+for an activation hook or timer). --ref pins a BAR branch, tag or commit; a
+full commit hash is fetched once and then served from the cache.
+
+--check converts the upstream excerpts in scripts/bar-uikeys-golden/ for
+every layout and diffs the result against the expected uikeys-<layout>.txt
+there (no network; the first, provenance line is not compared).
+--update-golden --ref COMMIT refetches those excerpts verbatim at a BAR
+commit (recorded in SOURCE) and writes the expected qwerty output with the
+original per-name re.sub converter, kept as convert_baseline(), so the check
+does not just compare convert() with itself. The other layouts have no such
+oracle: their expected files are written by generate() and must be reviewed
+by hand in the diff.
+
+Usage: bar-gen-uikeys.py [--layout NAME] [--ref REF] [--offline] [--base-url URL]
+       bar-gen-uikeys.py --bench [--offline]
+       bar-gen-uikeys.py --check
+       bar-gen-uikeys.py --update-golden --ref COMMIT
 """
+import argparse
+import difflib
+import functools
+import hashlib
+import json
+import os
 import re
+import sys
+import time
+import urllib.error
 import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-BASE = "https://raw.githubusercontent.com/beyond-all-reason/Beyond-All-Reason/master/luaui/configs/hotkeys"
+REPO = "https://raw.githubusercontent.com/beyond-all-reason/Beyond-All-Reason"
+HOTKEYS = "luaui/configs/hotkeys"
 FILES = ["chat_and_ui_keys.txt", "num_keys.txt", "legacy_keys.txt"]
+CACHE = Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") / "bar-gen-uikeys"
+DEST = Path.home() / ".local/state/Beyond All Reason/uikeys.txt"
+GOLDEN = Path(__file__).resolve().parent / "bar-uikeys-golden"
+TIMEOUT = 15
 
 NAMED = {
     "sc_comma": ",",
@@ -31,12 +70,64 @@ NAMED = {
     "sc_escape": "esc",
 }
 
-def convert(line: str) -> str:
+# Unshifted characters of the main key block, row by row. Each layout lists
+# what the key at the same position as on US QWERTY types.
+QWERTY = ("`1234567890-=", "qwertyuiop[]\\", "asdfghjkl;'", "zxcvbnm,./")
+LAYOUTS = {
+    "qwerty": QWERTY,
+    "dvorak": ("`1234567890[]", "',.pyfgcrl/=\\", "aoeuidhtns-", ";qjkxbmwvz"),
+    "colemak": ("`1234567890-=", "qwfpgjluy;[]\\", "arstdhneio'", "zxcvbkm,./"),
+    # French; the number row still binds as digits, and keys typing ² and ù
+    # (no BAR keycode) keep their QWERTY character
+    "azerty": ("`1234567890)=", "azertyuiop^$*", "qsdfghjklm'", "wxcvbn,;:!"),
+}
+
+# sc_<key>: a word (a, f1, comma) or a single symbol
+SCANCODE = re.compile(r"\bsc_(\w+|\S)")
+KEYLOAD = re.compile(r"^\s*keyload\b")
+
+@functools.cache
+def keycodes(layout: str) -> dict[str, str]:
+    """Scancode key name -> keycode for layout (names not listed stay as they are)."""
+    position = {q: c for q_row, row in zip(QWERTY, LAYOUTS[layout]) for q, c in zip(q_row, row)}
+    named = {name.removeprefix("sc_"): position.get(key, key) for name, key in NAMED.items()}
+    return {**position, **named}
+
+def convert(line: str, layout: str = "qwerty") -> str:
+    """Turn every sc_<key> in line into its keycode, in one pass."""
+    if "sc_" not in line:
+        return line
+    table = keycodes(layout)
+    return SCANCODE.sub(lambda m: table.get(m[1], m[1]), line)
+
+def generate(contents: list[str], layout: str, source: str) -> list[str]:
+    """uikeys.txt lines from the upstream FILES contents."""
+    if layout == "qwerty":
+        note = ["// Scancode (sc_X) bindings converted to keycode so BAR shortcuts",
+                "// match the typed character (Dvorak-friendly)."]
+    else:
+        note = ["// Scancode (sc_X) bindings converted to the keycodes the same keys",
+                f"// type on {layout}, so hotkeys keep their positions."]
+    out = [f"// Generated by scripts/bar-gen-uikeys.py from {source}", *note, "unbindall", ""]
+    for name, content in zip(FILES, contents):
+        out.append(f"// ==== from {name} ====")
+        for raw in content.splitlines():
+            if KEYLOAD.match(raw):
+                continue
+            out.append(convert(raw, layout))
+        out.append("")
+    return out
+
+# The converter as first written, one re.sub per name. Slow, but obviously
+# right for qwerty; --update-golden and --bench compare against it.
+
+def convert_baseline(line: str) -> str:
     for k, v in NAMED.items():
         line = re.sub(r"\b" + re.escape(k) + r"\b", lambda _, v=v: v, line)
     return re.sub(r"\bsc_(?=\S)", "", line)
 
-def main():
+def generate_baseline(contents: list[str]) -> list[str]:
+    """uikeys.txt lines exactly as the original qwerty-only script wrote them."""
     out = [
         "// Generated by scripts/bar-gen-uikeys.py",
         "// Scancode (sc_X) bindings converted to keycode so BAR shortcuts",
@@ -44,18 +135,153 @@ def main():
         "unbindall",
         "",
     ]
-    for name in FILES:
-        with urllib.request.urlopen(f"{BASE}/{name}") as r:
-            content = r.read().decode()
+    for name, content in zip(FILES, contents):
         out.append(f"// ==== from {name} ====")
         for raw in content.splitlines():
             if re.match(r"^\s*keyload\b", raw):
                 continue
-            out.append(convert(raw))
+            out.append(convert_baseline(raw))
         out.append("")
-    dest = Path.home() / ".local/state/Beyond All Reason/uikeys.txt"
-    dest.write_text("\n".join(out))
-    print(f"wrote {dest} ({len(out)} lines)")
+    return out
+
+def bench(contents: list[str], repeat: int = 50):
+    """Time convert_baseline() against convert() on contents."""
+    lines = [line for content in contents for line in content.splitlines()]
+    results = {}
+    for name, fn in (("old", convert_baseline), ("new", convert)):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            converted = [fn(line) for line in lines]
+        results[name] = (time.perf_counter() - start) / (repeat * len(lines)), converted
+    (old_time, old_out), (new_time, new_out) = results["old"], results["new"]
+    print(f"{len(lines)} lines x {repeat}: old {old_time * 1e6:.2f} us/line, "
+          f"new {new_time * 1e6:.2f} us/line ({old_time / new_time:.1f}x), "
+          f"output {'identical' if old_out == new_out else 'DIFFERS'}")
+    for layout in LAYOUTS:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for line in lines:
+                convert(line, layout)
+        print(f"  {layout}: {(time.perf_counter() - start) / (repeat * len(lines)) * 1e6:.2f} us/line")
+
+def check() -> bool:
+    """Diff generate() on the GOLDEN excerpts against uikeys-<layout>.txt, past the first line."""
+    contents = [(GOLDEN / name).read_text() for name in FILES]
+    ok = True
+    for layout in LAYOUTS:
+        path = GOLDEN / f"uikeys-{layout}.txt"
+        # Line 1 names the source (and the baseline's has none); compare the rest
+        text = generate(contents, layout, "bar-uikeys-golden")[1:]
+        expected = path.read_text().split("\n")[1:] if path.exists() else []
+        if text == expected:
+            print(f"{layout}: ok")
+            continue
+        ok = False
+        print(f"{layout}: differs from {path}")
+        for line in difflib.unified_diff(expected, text, str(path), f"generated ({layout})", lineterm=""):
+            print(line)
+    return ok
+
+def update_golden(ref: str):
+    """Refetch the GOLDEN excerpts at BAR commit ref and rewrite the expected output."""
+    if not re.fullmatch(r"[0-9a-f]{40}", ref):
+        sys.exit("--update-golden needs --ref set to a full BAR commit hash")
+    base = f"{REPO}/{ref}/{HOTKEYS}"
+    contents = fetch_all(base, immutable=True)
+    for name, content in zip(FILES, contents):
+        (GOLDEN / name).write_text(content)
+    (GOLDEN / "SOURCE").write_text(f"{base}\n")
+    (GOLDEN / "uikeys-qwerty.txt").write_text("\n".join(generate_baseline(contents)))
+    print(f"wrote {GOLDEN}: upstream files at {ref}, qwerty from convert_baseline()")
+    for layout in LAYOUTS:
+        if layout == "qwerty":
+            continue
+        (GOLDEN / f"uikeys-{layout}.txt").write_text("\n".join(generate(contents, layout, base)))
+        print(f"wrote uikeys-{layout}.txt from generate(): review its diff by hand")
+
+def fetch(url: str, cached: Path, offline: bool = False, immutable: bool = False) -> str:
+    """Return the file at url, revalidating (or, offline, just reading) the cached copy."""
+    meta_path = cached.with_name(cached.name + ".json")
+    meta = None
+    if cached.exists() and meta_path.exists():
+        meta = json.loads(meta_path.read_text())
+        if offline or immutable:
+            return cached.read_text()
+    elif offline:
+        sys.exit(f"--offline: {url} is not cached in {cached.parent}")
+
+    request = urllib.request.Request(url)
+    if meta and meta.get("etag"):
+        request.add_header("If-None-Match", meta["etag"])
+    if meta and meta.get("last_modified"):
+        request.add_header("If-Modified-Since", meta["last_modified"])
+    try:
+        with urllib.request.urlopen(request, timeout=TIMEOUT) as r:
+            content = r.read().decode()
+            meta = {"url": url, "etag": r.headers.get("ETag"),
+                    "last_modified": r.headers.get("Last-Modified")}
+    except urllib.error.HTTPError as e:
+        if e.code == 304 and meta is not None:
+            return cached.read_text()
+        if e.code < 500 or meta is None:
+            sys.exit(f"{url}: HTTP {e.code} {e.reason}")
+        print(f"{url}: HTTP {e.code}; using the cached copy", file=sys.stderr)
+        return cached.read_text()
+    except (urllib.error.URLError, TimeoutError) as e:
+        if meta is None:
+            sys.exit(f"{url}: {getattr(e, 'reason', e)}")
+        print(f"{url}: {getattr(e, 'reason', e)}; using the cached copy", file=sys.stderr)
+        return cached.read_text()
+
+    cached.parent.mkdir(parents=True, exist_ok=True)
+    cached.write_text(content)
+    meta_path.write_text(json.dumps(meta))
+    return content
+
+def fetch_all(base: str, offline: bool = False, immutable: bool = False) -> list[str]:
+    """FILES from base (a URL directory), fetched concurrently, in FILES order."""
+    cache = CACHE / hashlib.sha256(base.encode()).hexdigest()[:16]
+    with ThreadPoolExecutor(max_workers=len(FILES)) as pool:
+        return list(pool.map(lambda name: fetch(f"{base}/{name}", cache / name, offline, immutable), FILES))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--layout", choices=LAYOUTS, default="qwerty",
+                        help="keyboard layout whose key positions to keep (default: qwerty, "
+                             "i.e. keep the letters)")
+    parser.add_argument("--bench", action="store_true",
+                        help="time the conversion on the upstream files instead of writing")
+    parser.add_argument("--check", action="store_true",
+                        help="compare the conversion of the golden sample files with the expected output")
+    parser.add_argument("--update-golden", action="store_true",
+                        help="refetch the golden excerpts at --ref (a commit) and rewrite the expected output")
+    parser.add_argument("--ref", default="master", help="BAR branch, tag or commit (default: master)")
+    parser.add_argument("--offline", action="store_true", help="use the cached upstream files only")
+    parser.add_argument("--base-url", help=f"URL directory holding the hotkey files "
+                                           f"(default: {REPO}/<ref>/{HOTKEYS})")
+    args = parser.parse_args()
+
+    if args.update_golden:
+        update_golden(args.ref)
+        return
+    if args.check:
+        sys.exit(0 if check() else 1)
+
+    base = (args.base_url or f"{REPO}/{args.ref}/{HOTKEYS}").rstrip("/")
+    # Files at a commit never change upstream; once cached, skip the network
+    immutable = args.base_url is None and re.fullmatch(r"[0-9a-f]{40}", args.ref) is not None
+    contents = fetch_all(base, args.offline, immutable)
+    if args.bench:
+        bench(contents)
+        return
+
+    out = generate(contents, args.layout, base)
+    text = "\n".join(out)
+    if DEST.exists() and DEST.read_text() == text:
+        print(f"{DEST} is up to date")
+        return
+    DEST.write_text(text)
+    print(f"wrote {DEST} ({len(out)} lines)")
 
 if __name__ == "__main__":
     main()